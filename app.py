@@ -1,16 +1,28 @@
+import asyncio
+
 from fastapi import FastAPI, Request
 from fastapi.exceptions import StarletteHTTPException, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse
 
-from data.config import FRONTEND_URL
+from data.config import FRONTEND_URL, REDIS_TOKENS_DB, REDIS_CASHING_DB, CACHE_STATS_LOG_INTERVAL
 from routes.auth import router as AuthRouter
 from routes.book import router as BookRouter
 from routes.bookshelf import router as BookshelveRouter
 from routes.user import router as UserRouter
 from services.auth import remove_token
+from services.caching import search_results_cache
+from services.suggestions import run_suggestions_refresher
+from services.users import listen_users_invalidation, users_cache
+from utils.cache import log_caches_stats
+from utils.http import get_http_client, close_http_client
+from utils.indexes import ensure_indexes
+from utils.redis import get_redis, close_redis_pools
+from utils.responses import ORJSONResponse
+
+app = FastAPI(title='My Books History', default_response_class=ORJSONResponse)
 
-app = FastAPI(title='My Books History')
+_background_tasks: list[asyncio.Task] = []
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,9 +38,32 @@ app.include_router(BookRouter, prefix='/api/v1/books')
 app.include_router(BookshelveRouter, prefix='/api/v1/bookshelves')
 
 
+@app.on_event('startup')
+async def startup():
+    get_http_client()
+    await ensure_indexes()
+    for db in (REDIS_TOKENS_DB, REDIS_CASHING_DB):
+        await get_redis(db).ping()
+
+    _background_tasks.append(asyncio.create_task(listen_users_invalidation()))
+    _background_tasks.append(asyncio.create_task(run_suggestions_refresher()))
+    _background_tasks.append(asyncio.create_task(log_caches_stats({'search_results': search_results_cache,
+                                                                   'users': users_cache}, CACHE_STATS_LOG_INTERVAL)))
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+    await close_http_client()
+    await close_redis_pools()
+
+
 @app.exception_handler(StarletteHTTPException)
 async def validation_exception_handler(request: Request, exc: HTTPException):
-    response = JSONResponse({'detail': exc.detail}, status_code=exc.status_code)
+    response = ORJSONResponse({'detail': exc.detail}, status_code=exc.status_code)
 
     if exc.status_code == 423:
         refresh_token = request.cookies.get('refresh_token')
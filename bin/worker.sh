@@ -0,0 +1,3 @@
+#!/bin/sh
+
+python worker.py
\ No newline at end of file
@@ -8,8 +8,42 @@ REDIS_URL = config('REDIS_URL')
 
 REDIS_TOKENS_DB = config('REDIS_TOKENS_DB', cast=int, default=1)
 REDIS_CASHING_DB = config('REDIS_CASHING_DB', cast=int, default=2)
+REDIS_JOBS_DB = config('REDIS_JOBS_DB', cast=int, default=3)
+
+REDIS_MAX_CONNECTIONS = config('REDIS_MAX_CONNECTIONS', cast=int, default=50)  # per db
+REDIS_SOCKET_TIMEOUT = config('REDIS_SOCKET_TIMEOUT', cast=float, default=5)  # seconds
+REDIS_SOCKET_CONNECT_TIMEOUT = config('REDIS_SOCKET_CONNECT_TIMEOUT', cast=float, default=5)  # seconds
+REDIS_POOL_TIMEOUT = config('REDIS_POOL_TIMEOUT', cast=float, default=5)  # seconds to wait for a free connection
 
 SEARCH_RESULTS_CACHING_TIME = config('SEARCH_RESULTS_CACHING_TIME', cast=int, default=60 * 15)  # 15 minutes
+SEARCH_RESULTS_LOCAL_CACHE_SIZE = config('SEARCH_RESULTS_LOCAL_CACHE_SIZE', cast=int, default=1024)
+SEARCH_RESULTS_LOCAL_CACHING_TIME = config('SEARCH_RESULTS_LOCAL_CACHING_TIME', cast=int, default=60)  # 1 minute
+SEARCH_RESULTS_STALE_TIME = config('SEARCH_RESULTS_STALE_TIME', cast=int, default=60 * 60)  # served while refreshing
+SEARCH_RESULTS_REFRESH_LOCK_TIME = config('SEARCH_RESULTS_REFRESH_LOCK_TIME', cast=int, default=5000)  # milliseconds
+CACHE_STATS_LOG_INTERVAL = config('CACHE_STATS_LOG_INTERVAL', cast=int, default=60 * 5)  # 5 minutes
+
+SUGGESTIONS_SIZE = config('SUGGESTIONS_SIZE', cast=int, default=10000)  # queries and titles kept in memory
+SUGGESTIONS_REFRESH_INTERVAL = config('SUGGESTIONS_REFRESH_INTERVAL', cast=int, default=60)  # seconds
+
+MISSING_VOLUMES_CACHING_TIME = config('MISSING_VOLUMES_CACHING_TIME', cast=int, default=60 * 60 * 24)  # 1 day
+LIBRARY_VERSION_TIME = config('LIBRARY_VERSION_TIME', cast=int, default=60 * 60 * 24 * 30)  # 30 days
+
+EXPORT_BATCH_SIZE = config('EXPORT_BATCH_SIZE', cast=int, default=1000)  # documents per cursor batch
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', cast=int, default=64 * 1024)  # bytes per streamed chunk
+
+JOBS_WORKER_CONCURRENCY = config('JOBS_WORKER_CONCURRENCY', cast=int, default=16)
+JOBS_VISIBILITY_TIMEOUT = config('JOBS_VISIBILITY_TIMEOUT', cast=int, default=60 * 1000)  # milliseconds
+JOBS_MAX_RETRIES = config('JOBS_MAX_RETRIES', cast=int, default=5)
+JOBS_RETRY_DELAY = config('JOBS_RETRY_DELAY', cast=int, default=5)  # seconds, doubled on every retry
+JOBS_DEDUPLICATION_TIME = config('JOBS_DEDUPLICATION_TIME', cast=int, default=60 * 60)  # 1 hour
+
+WRITE_BEHIND_DEBOUNCE_TIME = config('WRITE_BEHIND_DEBOUNCE_TIME', cast=float, default=5)  # seconds
+WRITE_BEHIND_MAX_DELAY = config('WRITE_BEHIND_MAX_DELAY', cast=float, default=60)  # seconds since the first change
+WRITE_BEHIND_CONCURRENCY = config('WRITE_BEHIND_CONCURRENCY', cast=int, default=4)
+
+USERS_CACHE_SIZE = config('USERS_CACHE_SIZE', cast=int, default=10000)
+USERS_CACHING_TIME = config('USERS_CACHING_TIME', cast=int, default=60 * 5)  # 5 minutes
+USERS_ACTIVE_TIME = config('USERS_ACTIVE_TIME', cast=int, default=60 * 60)  # 1 hour since the last request
 
 JWT_SECRET = config('JWT_SECRET')
 JWT_ALGORITHM = config('JWT_ALGORITHM', default='HS256')
@@ -19,3 +53,30 @@ REFRESH_TOKEN_EXPIRE_MINUTES = config('REFRESH_TOKEN_EXPIRE_MINUTES', cast=int,
 GOOGLE_OAUTH_CLIENT_ID = config('GOOGLE_OAUTH_CLIENT_ID')
 GOOGLE_OAUTH_CLIENT_SECRET = config('GOOGLE_OAUTH_CLIENT_SECRET')
 GOOGLE_BOOKS_API_KEY = config('GOOGLE_BOOKS_API_KEY')
+
+GOOGLE_HTTP2 = config('GOOGLE_HTTP2', cast=bool, default=False)
+GOOGLE_HTTP_TIMEOUT = config('GOOGLE_HTTP_TIMEOUT', cast=float, default=10)  # seconds
+GOOGLE_HTTP_MAX_CONNECTIONS = config('GOOGLE_HTTP_MAX_CONNECTIONS', cast=int, default=100)
+GOOGLE_HTTP_MAX_KEEPALIVE_CONNECTIONS = config('GOOGLE_HTTP_MAX_KEEPALIVE_CONNECTIONS', cast=int, default=20)
+
+GOOGLE_TOKENS_REFRESH_LOCK_TIME = config('GOOGLE_TOKENS_REFRESH_LOCK_TIME', cast=int, default=10000)  # milliseconds
+GOOGLE_TOKENS_REFRESH_AHEAD = config('GOOGLE_TOKENS_REFRESH_AHEAD', cast=int, default=5 * 60)  # seconds before expiry
+GOOGLE_TOKENS_REFRESH_INTERVAL = config('GOOGLE_TOKENS_REFRESH_INTERVAL', cast=int, default=60)  # seconds
+
+GOOGLE_SYNC_USER_CONCURRENCY = config('GOOGLE_SYNC_USER_CONCURRENCY', cast=int, default=8)
+GOOGLE_SYNC_GLOBAL_CONCURRENCY = config('GOOGLE_SYNC_GLOBAL_CONCURRENCY', cast=int, default=64)
+SYNC_BULK_WRITE_SIZE = config('SYNC_BULK_WRITE_SIZE', cast=int, default=200)
+
+IMPORT_MAX_ENTRIES = config('IMPORT_MAX_ENTRIES', cast=int, default=10000)
+IMPORT_MAX_FILE_SIZE = config('IMPORT_MAX_FILE_SIZE', cast=int, default=5 * 1024 * 1024)  # bytes
+IMPORT_BATCH_SIZE = config('IMPORT_BATCH_SIZE', cast=int, default=100)
+IMPORT_CONCURRENCY = config('IMPORT_CONCURRENCY', cast=int, default=8)  # google books searches at once per import
+IMPORT_MAX_FAILURES = config('IMPORT_MAX_FAILURES', cast=int, default=100)  # failed entries kept for the report
+
+GOOGLE_BOOKS_RATE_LIMIT = config('GOOGLE_BOOKS_RATE_LIMIT', cast=float, default=10)  # requests per second
+GOOGLE_BOOKS_RATE_LIMIT_BURST = config('GOOGLE_BOOKS_RATE_LIMIT_BURST', cast=int, default=20)
+GOOGLE_BOOKS_RATE_LIMIT_RETRIES = config('GOOGLE_BOOKS_RATE_LIMIT_RETRIES', cast=int, default=3)
+GOOGLE_BOOKS_RATE_LIMIT_RECOVERY = config('GOOGLE_BOOKS_RATE_LIMIT_RECOVERY', cast=float, default=0.01)  # per second
+GOOGLE_BOOKS_BACKGROUND_RESERVE = config('GOOGLE_BOOKS_BACKGROUND_RESERVE', cast=float, default=0.3)  # of the burst
+GOOGLE_BOOKS_INTERACTIVE_TIMEOUT = config('GOOGLE_BOOKS_INTERACTIVE_TIMEOUT', cast=float, default=5)  # seconds
+GOOGLE_BOOKS_BACKGROUND_TIMEOUT = config('GOOGLE_BOOKS_BACKGROUND_TIMEOUT', cast=float, default=120)  # seconds
@@ -32,3 +32,11 @@ class GoogleAddToBookshelfError(Exception):
 
 class GoogleRemoveFromBookshelfError(Exception):
     pass
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+class InvalidImportFileError(Exception):
+    pass
@@ -1,5 +1,6 @@
 from .base import PyObjectId
-from .book import BookModel, BooksResponse, BookModelRead
+from .book import BookModel, BooksResponse, BookModelRead, BooksLookupRequest
 from .bookshelf import BookshelfModel, BookshelfModelRead
 from .credentials import CredentialsResponse
 from .user import UserModel, UserModelRead, UserBase, UserCredentialsModel
+from .book_import import BooksImportModelRead
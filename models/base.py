@@ -1,5 +1,9 @@
+import orjson
 from bson import ObjectId
 from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST
+
+from utils.responses import dumps
 
 
 class PyObjectId(ObjectId):
@@ -22,4 +26,30 @@ class _BaseModel(BaseModel):
     class Config:
         allow_population_by_field_name = True
         arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+        json_loads = orjson.loads
+        json_dumps = dumps
+
+    @classmethod
+    def projection(cls) -> dict[str, int]:
+        return {key: 1 for name, field in cls.__fields__.items() for key in (name, field.alias)}
+
+    @classmethod
+    def from_document(cls, document: dict):
+        # Builds the model from a document we wrote ourselves, without validating it again
+        values = {}
+        for name, field in cls.__fields__.items():
+            if field.alias in document:
+                value = document[field.alias]
+            elif name in document:
+                value = document[name]
+            else:
+                continue
+
+            if value is not None and isinstance(field.type_, type) and issubclass(field.type_, _BaseModel):
+                if field.shape == SHAPE_LIST:
+                    value = [field.type_.from_document(item) for item in value]
+                else:
+                    value = field.type_.from_document(value)
+            values[name] = value
+
+        return cls.construct(**values)
@@ -23,3 +23,8 @@ class BookModelRead(BookBase):
 class BooksResponse(_BaseModel):
     total_items: int = Field(..., alias='totalItems')
     items: list[BookModelRead] = Field(...)
+    next_cursor: str | None = Field(None, alias='nextCursor')
+
+
+class BooksLookupRequest(_BaseModel):
+    google_ids: list[str] = Field(..., alias='googleIds', min_items=1, max_items=300)
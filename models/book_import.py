@@ -0,0 +1,17 @@
+from datetime import datetime
+
+from pydantic import Field
+
+from models.base import PyObjectId, _BaseModel
+
+
+class BooksImportModelRead(_BaseModel):
+    id: PyObjectId = Field(..., alias='_id')
+    status: str = Field(...)
+    total: int = Field(...)
+    processed: int = Field(0)
+    imported: int = Field(0)
+    failed: int = Field(0)
+    failures: list[str] = Field([])
+    created_at: datetime = Field(..., alias='createdAt')
+    finished_at: datetime | None = Field(None, alias='finishedAt')
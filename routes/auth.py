@@ -1,17 +1,15 @@
-import json
-
-from fastapi import APIRouter, Form, Query, HTTPException, status, Cookie, BackgroundTasks
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import RedirectResponse, JSONResponse, Response
+from fastapi import APIRouter, Form, Query, HTTPException, status, Cookie
+from fastapi.responses import RedirectResponse, Response
 
 from data.config import SERVER_URL, FRONTEND_URL
 from exceptions import GoogleTokenError, GoogleCodeTokenError
-from models import UserModel, CredentialsResponse, UserModelRead, UserCredentialsModel
-from services.auth import is_token_exits, remove_token, get_current_user, create_tokens, REFRESH_TOKEN_EXPIRE_MINUTES
+from models import UserModel, CredentialsResponse, UserCredentialsModel
+from services.auth import remove_token, get_current_user, create_tokens, rotate_tokens, REFRESH_TOKEN_EXPIRE_MINUTES
 from services.google import generate_auth_uri, get_token, get_tokeninfo
-from services.synchronization import synchronize_books, synchronize_user
+from services.jobs import enqueue_job
 from services.users import update_or_create_user
 from utils.misc.logging import logger
+from utils.responses import ORJSONResponse, dumps
 
 router = APIRouter(tags=['Oauth2'])
 
@@ -28,28 +26,27 @@ async def oauth_google(redirect_uri: str = f'{SERVER_URL}/oauth/google/redirect'
 
 
 @router.get('/google/redirect', include_in_schema=False)
-async def oauth_google_redirect(background_tasks: BackgroundTasks, code: str, scope: str,
+async def oauth_google_redirect(code: str, scope: str,
                                 redirect_uri: str = f'{SERVER_URL}/oauth/google/redirect'):
     # If user have not given permission to manage google books
     if 'https://www.googleapis.com/auth/books' not in scope:
         return await oauth_google(redirect_uri)
 
-    return await _oauth_google_redirect(code, redirect_uri, background_tasks=background_tasks,
-                                        redirect_to_frontend=True)
+    return await _oauth_google_redirect(code, redirect_uri, redirect_to_frontend=True)
 
 
 @router.post('/google/redirect', include_in_schema=False, response_model=CredentialsResponse,
              description='Oauth2 for swagger docs')
-async def oauth_google_redirect_swagger(background_tasks: BackgroundTasks, code: str = Form(...),
-                                        redirect_uri: str = Form(...), swagger: bool = Query(False)):
-    return await _oauth_google_redirect(code, redirect_uri, background_tasks=background_tasks, swagger=swagger)
+async def oauth_google_redirect_swagger(code: str = Form(...), redirect_uri: str = Form(...),
+                                        swagger: bool = Query(False)):
+    return await _oauth_google_redirect(code, redirect_uri, swagger=swagger)
 
 
-async def _oauth_google_redirect(code: str, redirect_uri: str, background_tasks: BackgroundTasks = None,
-                                 swagger=False, redirect_to_frontend=False) -> JSONResponse:
+async def _oauth_google_redirect(code: str, redirect_uri: str, swagger=False,
+                                 redirect_to_frontend=False) -> Response:
     try:
-        access_data = get_token(code, redirect_uri)
-        tokeninfo = get_tokeninfo(access_data.access_token)
+        access_data = await get_token(code, redirect_uri)
+        tokeninfo = await get_tokeninfo(access_data.access_token)
     except (GoogleTokenError, GoogleCodeTokenError) as e:
         logger.error(f'{type(e).__name__} {e}')
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
@@ -62,7 +59,7 @@ async def _oauth_google_redirect(code: str, redirect_uri: str, background_tasks:
 
     access_token, refresh_token = await create_tokens({'sub': str(user.id)}, {'sub': str(user.id)})
     response_content = {'accessToken': access_token,
-                        'user': jsonable_encoder(UserModelRead.parse_obj(jsonable_encoder(user))),
+                        'user': user.dict(by_alias=True, exclude={'credentials'}),
                         'tokenType': 'Bearer'}
 
     # Snake case for swagger docs
@@ -70,34 +67,32 @@ async def _oauth_google_redirect(code: str, redirect_uri: str, background_tasks:
         response_content['access_token'] = access_token
 
     if redirect_to_frontend:
-        uri = FRONTEND_URL + '/oauth2-redirect.html#' + json.dumps(response_content)
+        uri = FRONTEND_URL + '/oauth2-redirect.html#' + dumps(response_content)
         response = RedirectResponse(uri)
     else:
-        response = JSONResponse(content=response_content)
+        response = ORJSONResponse(content=response_content)
 
     response.set_cookie(key='refresh_token', value=refresh_token, httponly=True, secure=True,
                         max_age=REFRESH_TOKEN_EXPIRE_MINUTES * 60)  # convert minutes to seconds
 
-    if background_tasks:
-        background_tasks.add_task(synchronize_user, user=user)
-        background_tasks.add_task(synchronize_books, user=user)
+    await enqueue_job('synchronize_user', {'user_id': str(user.id)}, dedup_key=f'synchronize_user:{user.id}')
+    await enqueue_job('synchronize_books', {'user_id': str(user.id)}, dedup_key=f'synchronize_books:{user.id}')
 
     return response
 
 
 @router.get('/refresh', response_model=CredentialsResponse)
 async def oauth_refresh_token(refresh_token: str = Cookie(...)):
-    if not await is_token_exits(refresh_token):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
-
     current_user = await get_current_user(refresh_token)
 
-    await remove_token(refresh_token)
+    credentials = await rotate_tokens(refresh_token, {'sub': str(current_user.id)}, {'sub': str(current_user.id)})
+    if not credentials:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
 
-    access_token, refresh_token = await create_tokens({'sub': str(current_user.id)}, {'sub': str(current_user.id)})
-    response = JSONResponse(
+    access_token, refresh_token = credentials
+    response = ORJSONResponse(
         content={'accessToken': access_token,
-                 'user': jsonable_encoder(UserModelRead.parse_obj(current_user)),
+                 'user': current_user.dict(by_alias=True, exclude={'credentials'}),
                  'tokenType': 'Bearer'}
     )
     response.set_cookie(key='refresh_token', value=refresh_token, httponly=True, secure=True,
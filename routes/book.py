@@ -1,46 +1,134 @@
 from bson import ObjectId
-from fastapi import APIRouter, HTTPException, status, Query, Depends, Form, BackgroundTasks
-
-from exceptions import GoogleBooksSearchError, GoogleGetBookError
-from models import BooksResponse, UserModel, BookModelRead
-from services.auth import get_current_active_user
-from services.books import search_google_books, get_book_from_google, get_or_create_book, get_books_by_user_id, get_book
-from services.caching import get_cache_data, set_cache_data
-from services.synchronization import synchronize_bookshelves_books
+from fastapi import APIRouter, HTTPException, status, Query, Depends, Form, File, UploadFile
+from fastapi.responses import StreamingResponse
+
+from data.config import IMPORT_MAX_FILE_SIZE
+from exceptions import GoogleBooksSearchError, GoogleGetBookError, InvalidCursorError, InvalidImportFileError
+from models import BooksResponse, UserModel, BookModelRead, BooksLookupRequest, BooksImportModelRead
+from services.auth import get_current_active_user, get_current_user_id
+from services.books import search_google_books, get_book_from_google, get_or_create_book, get_books_by_user_id, \
+    get_book, get_books_by_google_ids, search_library_books
+from services.caching import get_search_results
+from services.export import iter_library, iter_ndjson, iter_csv, gzip_chunks
+from services.imports import parse_import_file, create_import, get_import
+from services.suggestions import record_search_query, suggest
+from services.write_behind import buffer_bookshelves_change
 from utils.misc.logging import logger
+from utils.responses import ORJSONResponse
 
 router = APIRouter(tags=['Books'])
 
 
+@router.get('/', response_model=BooksResponse)
+async def get_library(start_index: int = Query(0, alias='startIndex', ge=0),
+                      max_results: int = Query(16, alias='maxResults', ge=1, le=40), cursor: str | None = Query(None),
+                      current_user: UserModel = Depends(get_current_active_user)):
+    try:
+        books, total_items, next_cursor = await get_books_by_user_id(current_user.id, limit=max_results,
+                                                                     offset=start_index, cursor=cursor)
+    except InvalidCursorError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+    books_response = BooksResponse.construct(items=books, total_items=total_items, next_cursor=next_cursor)
+    return ORJSONResponse(books_response.dict(by_alias=True))
+
+
 @router.get('/search', response_model=BooksResponse)
-async def search(background_tasks: BackgroundTasks, q: str = Query(...),
+async def search(q: str = Query(...),
                  start_index: int = Query(0, alias='startIndex', ge=0),
                  max_results: int = Query(16, alias='maxResults', ge=1, le=40),
                  current_user: UserModel = Depends(get_current_active_user)):
     try:
-        cached_books_response = await get_cache_data(f'{q}:{start_index}:{max_results}')
-        if cached_books_response:
-            books_response = BooksResponse.parse_raw(cached_books_response)
-        else:
-            books_response = search_google_books(q, start_index, max_results)
-            background_tasks.add_task(set_cache_data, f'{q}:{start_index}:{max_results}', books_response.json())
+        books_response = await get_search_results(f'{q}:{start_index}:{max_results}',
+                                                  lambda: search_google_books(q, start_index, max_results))
 
     except GoogleBooksSearchError as e:
         logger.error(f'Search {q=} error {e} message {e.args[0]}')
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
 
+    # Only the first pages are what users type
+    if not start_index:
+        record_search_query(q)
+
     found_books_ids = list(map(lambda b: b.google_id, books_response.items))
     # Get from the database only found books through the search and not all at once
-    external_books, _ = await get_books_by_user_id(current_user.id, google_ids=found_books_ids,
-                                                   limit=max_results, offset=start_index)
+    external_books = await get_books_by_google_ids(current_user.id, found_books_ids)
+
+    books_response.items = [external_books.get(item.google_id, item) for item in books_response.items]
+
+    return ORJSONResponse(books_response.dict(by_alias=True))
+
+
+@router.get('/suggest', response_model=list[str])
+async def suggest_queries(prefix: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=20),
+                          user_id: str = Depends(get_current_user_id)):
+    # Served from memory, the token is checked without loading the user
+    return ORJSONResponse(suggest(prefix, limit))
+
+
+@router.get('/library/search', response_model=BooksResponse)
+async def search_library(q: str = Query(..., min_length=1), prefix: bool = Query(False),
+                         start_index: int = Query(0, alias='startIndex', ge=0),
+                         max_results: int = Query(16, alias='maxResults', ge=1, le=40),
+                         current_user: UserModel = Depends(get_current_active_user)):
+    books, total_items = await search_library_books(current_user.id, q, prefix=prefix, limit=max_results,
+                                                    offset=start_index)
+
+    books_response = BooksResponse.construct(items=books, total_items=total_items, next_cursor=None)
+    return ORJSONResponse(books_response.dict(by_alias=True))
+
+
+@router.post('/lookup', response_model=list[BookModelRead])
+async def lookup_books(lookup: BooksLookupRequest, current_user: UserModel = Depends(get_current_active_user)):
+    books = await get_books_by_google_ids(current_user.id, list(dict.fromkeys(lookup.google_ids)))
 
-    result = []
-    for item in books_response.items:
-        result.append(next((i for i in external_books if i.google_id == item.google_id), item))
+    return ORJSONResponse([book.dict(by_alias=True) for book in books.values()])
 
-    books_response.items = result
 
-    return books_response
+@router.get('/export', response_class=StreamingResponse)
+async def export_library(format: str = Query('ndjson', regex='^(ndjson|csv)$'), gzip: bool = Query(False),
+                         current_user: UserModel = Depends(get_current_active_user)):
+    if format == 'csv':
+        content, media_type = iter_csv(iter_library(current_user.id)), 'text/csv'
+    else:
+        content, media_type = iter_ndjson(iter_library(current_user.id)), 'application/x-ndjson'
+
+    filename = f'library.{format}'
+    if gzip:
+        content, media_type, filename = gzip_chunks(content), 'application/gzip', f'{filename}.gz'
+
+    return StreamingResponse(content, media_type=media_type,
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@router.post('/import', response_model=BooksImportModelRead, status_code=status.HTTP_202_ACCEPTED)
+async def import_books(file: UploadFile = File(...), bookshelf: int = Form(2),
+                       current_user: UserModel = Depends(get_current_active_user)):
+    if bookshelf not in {b.id for b in current_user.bookshelves}:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Unknown bookshelf')
+
+    # Read one byte over the limit to tell an oversized file without reading all of it
+    content = await file.read(IMPORT_MAX_FILE_SIZE + 1)
+    if len(content) > IMPORT_MAX_FILE_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f'The file must be at most {IMPORT_MAX_FILE_SIZE} bytes')
+
+    try:
+        entries = parse_import_file(content, bookshelf)
+    except InvalidImportFileError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    books_import = await create_import(current_user.id, entries)
+    return ORJSONResponse(books_import.dict(by_alias=True), status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.get('/import/{id}', response_model=BooksImportModelRead)
+async def get_import_progress(id: str, current_user: UserModel = Depends(get_current_active_user)):
+    books_import = await get_import(current_user.id, id)
+    if not books_import:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    return ORJSONResponse(books_import.dict(by_alias=True))
 
 
 @router.get('/{id}/', response_model=BookModelRead)
@@ -49,18 +137,18 @@ async def get_book_by_id(id: str, current_user: UserModel = Depends(get_current_
     if not book:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
-    return book
+    return ORJSONResponse(book.dict(by_alias=True, exclude={'user_id'}))
 
 
 @router.post('/{id}/setBookshelves', response_model=BookModelRead)
-async def set_bookshelves(background_tasks: BackgroundTasks, id: str, bookshelves: list[int] = Form(list()),
+async def set_bookshelves(id: str, bookshelves: list[int] = Form(list()),
                           current_user: UserModel = Depends(get_current_active_user)):
     book = await get_book(current_user.id, id)
     if book:
         old_bookshelves = book.bookshelves
     else:
         try:
-            book = get_book_from_google(id)
+            book = await get_book_from_google(id)
         except GoogleGetBookError as e:
             logger.error(f'{type(e).__name__} {e}')
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
@@ -71,7 +159,6 @@ async def set_bookshelves(background_tasks: BackgroundTasks, id: str, bookshelve
 
     new_book = await get_or_create_book(book)
 
-    background_tasks.add_task(synchronize_bookshelves_books, old_bookshelves=old_bookshelves, book=new_book,
-                              user=current_user)
+    await buffer_bookshelves_change(str(current_user.id), new_book.google_id, old_bookshelves, new_book.bookshelves)
 
-    return new_book
+    return ORJSONResponse(new_book.dict(by_alias=True, exclude={'user_id'}))
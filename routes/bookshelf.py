@@ -1,25 +1,45 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request
+from fastapi.responses import Response
 
-from exceptions import GoogleGetBookshelvesError
-from models import BookshelfModelRead, UserModel, BooksResponse
-from services.auth import get_current_active_user
+from exceptions import GoogleGetBookshelvesError, InvalidCursorError
+from models import BookshelfModelRead, BooksResponse
+from services.auth import get_current_user_id, load_current_user
 from services.books import get_books_by_user_id
 from services.google_bookshelves import GoogleBookshelvesService
+from services.versions import get_library_etag, is_not_modified, etag_headers
 from utils.misc.logging import logger
+from utils.responses import ORJSONResponse
 
 router = APIRouter(tags=['Bookshelves'])
 
 
 @router.get('/', response_model=list[BookshelfModelRead])
-async def get_bookshelves(current_user: UserModel = Depends(get_current_active_user)):
-    return current_user.bookshelves
+async def get_bookshelves(request: Request, user_id: str = Depends(get_current_user_id)):
+    etag = await get_library_etag(user_id, request)
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag))
+
+    current_user = await load_current_user(user_id)
+    return ORJSONResponse([bookshelf.dict(by_alias=True) for bookshelf in current_user.bookshelves],
+                          headers=etag_headers(etag))
 
 
 @router.get('/{id}/', response_model=BooksResponse)
-async def get_books(id: int, start_index: int = Query(0, alias='startIndex', ge=0),
-                    max_results: int = Query(16, alias='maxResults', ge=1, le=40),
-                    current_user: UserModel = Depends(get_current_active_user)):
-    books, total_items = await get_books_by_user_id(current_user.id, bookshelves=[id],
-                                                    limit=max_results, offset=start_index)
+async def get_books(request: Request, id: int, start_index: int = Query(0, alias='startIndex', ge=0),
+                    max_results: int = Query(16, alias='maxResults', ge=1, le=40), cursor: str | None = Query(None),
+                    user_id: str = Depends(get_current_user_id)):
+    # The query parameters are a part of the etag
+    etag = await get_library_etag(user_id, request)
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag))
+
+    current_user = await load_current_user(user_id)
+    try:
+        books, total_items, next_cursor = await get_books_by_user_id(current_user.id, bookshelves=[id],
+                                                                     limit=max_results, offset=start_index,
+                                                                     cursor=cursor)
+    except InvalidCursorError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
 
-    return BooksResponse(items=books, total_items=total_items)
+    books_response = BooksResponse.construct(items=books, total_items=total_items, next_cursor=next_cursor)
+    return ORJSONResponse(books_response.dict(by_alias=True), headers=etag_headers(etag))
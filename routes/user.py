@@ -1,14 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi.responses import Response
 
 from exceptions import GoogleGetBookshelvesError
-from models import UserModel, UserModelRead
-from services.auth import get_current_active_user
+from models import UserModelRead
+from services.auth import get_current_user_id, load_current_user
 from services.google_bookshelves import GoogleBookshelvesService
+from services.versions import get_library_etag, is_not_modified, etag_headers
 from utils.misc.logging import logger
+from utils.responses import ORJSONResponse
 
 router = APIRouter(tags=['User'])
 
 
 @router.get('/me/', response_model=UserModelRead)
-async def get_current_user(current_user: UserModel = Depends(get_current_active_user)):
-    return UserModelRead(**current_user.dict())
+async def get_current_user(request: Request, user_id: str = Depends(get_current_user_id)):
+    etag = await get_library_etag(user_id, request)
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag))
+
+    current_user = await load_current_user(user_id)
+    # The response model fields are the user fields without credentials, no need to validate them again
+    return ORJSONResponse(current_user.dict(by_alias=True, exclude={'credentials'}), headers=etag_headers(etag))
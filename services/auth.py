@@ -1,83 +1,130 @@
+import uuid
 from datetime import datetime, timedelta
 from typing import NamedTuple
 
-import aioredis
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from jose import JWTError, jwt
 
-from data.config import JWT_SECRET, REDIS_URL, JWT_ALGORITHM, REFRESH_TOKEN_EXPIRE_MINUTES, \
+from data.config import JWT_SECRET, JWT_ALGORITHM, REFRESH_TOKEN_EXPIRE_MINUTES, \
     ACCESS_TOKEN_EXPIRE_MINUTES, REDIS_TOKENS_DB
 from models import UserModel
-from services.users import get_user_by_id
+from services.users import get_user_by_id, mark_user_active
+from utils.redis import get_redis
 
 oauth2_scheme = OAuth2AuthorizationCodeBearer(tokenUrl='/oauth/google/redirect?swagger=1',
                                               authorizationUrl='/oauth/google',
                                               description='__Leave blank credentials__')
 
 
+# Refresh tokens store the id of their family, every token issued by rotation from one login shares it
+_rotate_token_script = """
+local family = redis.call('get', KEYS[1])
+if not family then
+    local rotated_family = redis.call('get', 'rotated:' .. KEYS[1])
+    if rotated_family then
+        -- An already rotated token is used again, so the whole family is revoked
+        for _, token in ipairs(redis.call('smembers', 'family:' .. rotated_family)) do
+            redis.call('del', token)
+        end
+        redis.call('del', 'family:' .. rotated_family)
+        return -1
+    end
+    return 0
+end
+
+-- Tokens saved before families existed start a new one
+if family == 'white' then
+    family = ARGV[2]
+end
+
+redis.call('del', KEYS[1])
+redis.call('srem', 'family:' .. family, KEYS[1])
+redis.call('set', 'rotated:' .. KEYS[1], family, 'EX', ARGV[1])
+redis.call('set', KEYS[2], family, 'EX', ARGV[1])
+redis.call('sadd', 'family:' .. family, KEYS[2])
+redis.call('expire', 'family:' .. family, ARGV[1])
+return 1
+"""
+
+
 class Credentials(NamedTuple):
     access_token: str
     refresh_token: str
 
 
-async def create_tokens(access_data: dict, refresh_data: dict) -> Credentials:
+def encode_tokens(access_data: dict, refresh_data: dict) -> Credentials:
     access_data.update({'exp': datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)})
     access_token = jwt.encode(access_data, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-    refresh_data.update({'exp': datetime.utcnow() + timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)})
+    # jti makes tokens issued in the same second unique
+    refresh_data.update({'exp': datetime.utcnow() + timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES),
+                         'jti': uuid.uuid4().hex})
     refresh_token = jwt.encode(refresh_data, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-    await save_token(refresh_token, 'white', REFRESH_TOKEN_EXPIRE_MINUTES * 60)  # convert minutes to seconds
-
     return Credentials(access_token, refresh_token)
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserModel:
-    credentials_exception = HTTPException(
+async def create_tokens(access_data: dict, refresh_data: dict) -> Credentials:
+    credentials = encode_tokens(access_data, refresh_data)
+
+    family = uuid.uuid4().hex
+    async with get_redis(REDIS_TOKENS_DB).pipeline(transaction=True) as pipe:
+        pipe.set(credentials.refresh_token, family, ex=REFRESH_TOKEN_EXPIRE_MINUTES * 60)  # convert minutes to seconds
+        pipe.sadd(f'family:{family}', credentials.refresh_token)
+        pipe.expire(f'family:{family}', REFRESH_TOKEN_EXPIRE_MINUTES * 60)
+        await pipe.execute()
+
+    return credentials
+
+
+async def rotate_tokens(refresh_token: str, access_data: dict, refresh_data: dict) -> Credentials | None:
+    credentials = encode_tokens(access_data, refresh_data)
+
+    # Checks and removes the old token and saves the new one in a single atomic step
+    result = await get_redis(REDIS_TOKENS_DB).eval(_rotate_token_script, 2, refresh_token, credentials.refresh_token,
+                                                   REFRESH_TOKEN_EXPIRE_MINUTES * 60, uuid.uuid4().hex)
+
+    return credentials if result == 1 else None
+
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
         headers={'WWW-Authenticate': 'Bearer'},
     )
+
+
+async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
+    # Authenticates the request by the token alone, without loading the user
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         id: str = payload.get('sub')
         if id is None:
-            raise credentials_exception
+            raise _credentials_exception()
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+
+    await mark_user_active(id)
+    return id
 
+
+async def load_current_user(id: str) -> UserModel:
     user = await get_user_by_id(id)
     if user is None:
-        raise credentials_exception
-    return user
+        raise _credentials_exception()
 
-
-async def get_current_active_user(current_user: UserModel = Depends(get_current_user)) -> UserModel:
-    return current_user
+    return user
 
 
-async def save_token(token: str, value: str, ex: int):
-    redis = aioredis.from_url(REDIS_URL + f'?db={REDIS_TOKENS_DB}', decode_responses=True)
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserModel:
+    return await load_current_user(await get_current_user_id(token))
 
-    await redis.set(token, value, ex=ex)
 
-    await redis.close()
+async def get_current_active_user(current_user: UserModel = Depends(get_current_user)) -> UserModel:
+    return current_user
 
 
 async def remove_token(token: str):
-    redis = aioredis.from_url(REDIS_URL + f'?db={REDIS_TOKENS_DB}', decode_responses=True)
-
-    await redis.delete(token)
-
-    await redis.close()
-
-
-async def is_token_exits(token: str):
-    redis = aioredis.from_url(REDIS_URL + f'?db={REDIS_TOKENS_DB}', decode_responses=True)
-
-    result = await redis.exists(token)
-
-    await redis.close()
-
-    return result
+    await get_redis(REDIS_TOKENS_DB).delete(token)
@@ -1,15 +1,36 @@
-import requests
+import asyncio
+import base64
+import re
+from datetime import datetime
+
 from bson import ObjectId
-from pymongo import ReturnDocument
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError
 
-from data.config import GOOGLE_BOOKS_API_KEY
+from data.config import GOOGLE_BOOKS_API_KEY, REDIS_CASHING_DB, MISSING_VOLUMES_CACHING_TIME, SYNC_BULK_WRITE_SIZE
 from utils.db import db
-from exceptions import GoogleBooksSearchError, GoogleGetBookError
+from exceptions import GoogleBooksSearchError, GoogleGetBookError, InvalidCursorError
 from models import BookModel, BooksResponse, BookModelRead
+from services.counters import update_counters, count_books
+from services.versions import bump_library_version
+from utils.http import google_books_request
+from utils.misc.logging import logger
+from utils.rate_limiter import PRIORITY_INTERACTIVE
+from utils.redis import get_redis
+from utils.text import normalize_text
+
+VOLUME_FIELDS = ('title', 'authors', 'image')
 
+# Only the fields the models are built from are read, _id is always returned for the cursors
+VOLUME_PROJECTION = dict.fromkeys(VOLUME_FIELDS, 1)
+BOOK_READ_PROJECTION = BookModelRead.projection()
+BOOK_PROJECTION = BookModel.projection()
 
-def search_google_books(query: str, start_index: int = None, max_results: int = None, print_type: str = 'books',
-                        projection: str = 'lite') -> BooksResponse:
+
+async def search_google_books(query: str, start_index: int = None, max_results: int = None,
+                              print_type: str = 'books', projection: str = 'lite',
+                              priority: int = PRIORITY_INTERACTIVE) -> BooksResponse:
     url = 'https://www.googleapis.com/books/v1/volumes'
     params = {
         'q': query,
@@ -21,7 +42,7 @@ def search_google_books(query: str, start_index: int = None, max_results: int =
     }
     params = dict(filter(lambda i: i[1] is not None, params.items()))
 
-    response = requests.request('GET', url, params=params).json()
+    response = await google_books_request('GET', url, params=params, priority=priority)
     if 'error' in response:
         raise GoogleBooksSearchError(response)
 
@@ -42,14 +63,25 @@ def search_google_books(query: str, start_index: int = None, max_results: int =
     return BooksResponse(total_items=response['totalItems'], items=books)
 
 
-def get_book_from_google(id: str) -> BookModel:
+async def get_book_from_google(id: str) -> BookModel:
+    volume = await db['volumes'].find_one({'_id': id}, VOLUME_PROJECTION)
+    if volume:
+        return BookModel(google_id=id, **{field: volume[field] for field in VOLUME_FIELDS if field in volume})
+
+    redis = get_redis(REDIS_CASHING_DB)
+    if await redis.exists(f'volume:missing:{id}'):
+        raise GoogleGetBookError({'error': {'code': 404, 'message': 'The volume ID could not be found.'}})
+
     url = f'https://www.googleapis.com/books/v1/volumes/{id}/'
     params = {
         'key': GOOGLE_BOOKS_API_KEY,
     }
 
-    response = requests.request('GET', url, params=params).json()
+    response = await google_books_request('GET', url, params=params)
     if 'error' in response:
+        # Remember invalid ids, but not quota or network errors
+        if response['error'].get('code') in (400, 404):
+            await redis.set(f'volume:missing:{id}', 1, ex=MISSING_VOLUMES_CACHING_TIME)
         raise GoogleGetBookError(response)
 
     volume_info = response['volumeInfo']
@@ -59,12 +91,74 @@ def get_book_from_google(id: str) -> BookModel:
         authors=volume_info['authors'] if 'authors' in volume_info else [],
         image=volume_info['imageLinks']['thumbnail'] if volume_info['readingModes']['image'] else None,
     )
+    await upsert_volumes([book])
 
     return book
 
 
+def _search_fields(book: BookModel) -> dict:
+    # Books keep a normalized copy of their volume text for the library search
+    return {'search_text': normalize_text(' '.join([book.title or '', *book.authors])),
+            'title_norm': normalize_text(book.title or '')}
+
+
+async def upsert_volumes(books: list[BookModel], overwrite: bool = True):
+    operator = '$set' if overwrite else '$setOnInsert'
+    operations = [
+        UpdateOne({'_id': book.google_id}, {operator: {field: getattr(book, field) for field in VOLUME_FIELDS}},
+                  upsert=True)
+        for book in books
+    ]
+    if operations:
+        await db['volumes'].bulk_write(operations, ordered=False)
+
+
+async def join_volumes(documents: list[dict]) -> list[dict]:
+    volumes = {}
+    if documents:
+        async for volume in db['volumes'].find({'_id': {'$in': [d['google_id'] for d in documents]}},
+                                               VOLUME_PROJECTION):
+            volumes[volume['_id']] = volume
+
+    # Books saved before the catalog existed still keep their own copy of the volume fields
+    for document in documents:
+        volume = volumes.get(document['google_id'])
+        if volume:
+            document.update((field, volume[field]) for field in VOLUME_FIELDS if field in volume)
+
+    return documents
+
+
+async def get_volumes_by_isbns(isbns: list[str]) -> dict[str, BookModel]:
+    volumes, wanted = {}, set(isbns)
+    if isbns:
+        async for volume in db['volumes'].find({'isbns': {'$in': isbns}}, {**VOLUME_PROJECTION, 'isbns': 1}):
+            book = BookModel.from_document({'google_id': volume['_id'], **volume})
+            volumes.update((isbn, book) for isbn in volume['isbns'] if isbn in wanted)
+
+    return volumes
+
+
+async def add_volumes_isbns(isbns: dict[str, str]):
+    operations = [UpdateOne({'_id': google_id}, {'$addToSet': {'isbns': isbn}}) for isbn, google_id in isbns.items()]
+    if operations:
+        await db['volumes'].bulk_write(operations, ordered=False)
+
+
+def encode_cursor(id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(id.binary).decode()
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, InvalidId):
+        raise InvalidCursorError(cursor)
+
+
 async def get_books_by_user_id(user_id: ObjectId, bookshelves: list[int] = None, google_ids: list[str] = None,
-                               limit: int = None, offset: int = 0) -> tuple[list[BookModelRead], int]:
+                               limit: int = None, offset: int = 0,
+                               cursor: str = None) -> tuple[list[BookModelRead], int, str | None]:
     query = {'user_id': user_id}
 
     if bookshelves:
@@ -73,7 +167,9 @@ async def get_books_by_user_id(user_id: ObjectId, bookshelves: list[int] = None,
     if google_ids:
         query['google_id'] = {'$in': google_ids}
 
-    total_items = await db['books'].count_documents(query)
+    total_items = None if google_ids else await count_books(user_id, bookshelves)
+    if total_items is None:
+        total_items = await db['books'].count_documents(query)
 
     if google_ids:
         length = len(google_ids)
@@ -82,21 +178,174 @@ async def get_books_by_user_id(user_id: ObjectId, bookshelves: list[int] = None,
     else:
         length = limit
 
-    books = []
-    for document in await db['books'].find(query).skip(offset).limit(limit).to_list(length=length):
-        books.append(document)
+    # Keyset pagination continues after the last seen _id instead of skipping documents
+    if cursor:
+        query['_id'] = {'$gt': decode_cursor(cursor)}
+        offset = 0
 
-    return [BookModelRead(**book) for book in books] if books else [], total_items
+    documents = await db['books'].find(query, BOOK_READ_PROJECTION).sort('_id', ASCENDING).skip(offset).limit(limit) \
+        .to_list(length=length)
+    next_cursor = encode_cursor(documents[-1]['_id']) if limit and len(documents) == limit else None
+    await join_volumes(documents)
+
+    return [BookModelRead.from_document(book) for book in documents], total_items, next_cursor
+
+
+async def get_books_by_google_ids(user_id: ObjectId, google_ids: list[str]) -> dict[str, BookModelRead]:
+    if not google_ids:
+        return {}
+
+    documents = await db['books'].find({'user_id': user_id, 'google_id': {'$in': google_ids}}, BOOK_READ_PROJECTION) \
+        .to_list(length=len(google_ids))
+
+    return {book['google_id']: BookModelRead.from_document(book) for book in await join_volumes(documents)}
 
 
 async def get_book(user_id: ObjectId, book_id: str) -> BookModel | None:
-    book = await db['books'].find_one({'user_id': user_id, 'google_id': book_id})
-    return BookModel.parse_obj(book) if book else None
+    book = await db['books'].find_one({'user_id': user_id, 'google_id': book_id}, BOOK_PROJECTION)
+    if not book:
+        return None
+
+    book, = await join_volumes([book])
+    return BookModel.from_document(book)
 
 
 async def get_or_create_book(book: BookModel) -> BookModel:
-    new_book = await db['books'].find_one_and_update({'google_id': book.google_id, 'user_id': book.user_id},
-                                                     {'$set': book.dict()},
-                                                     return_document=ReturnDocument.AFTER, upsert=True)
+    # Keeps the volume fields of books saved before the catalog existed, they are unset below
+    if book.title:
+        await upsert_volumes([book], overwrite=False)
+
+    # The document before the update tells how the shelves counters change
+    old_book = await db['books'].find_one_and_update({'google_id': book.google_id, 'user_id': book.user_id},
+                                                     {'$set': {'bookshelves': book.bookshelves,
+                                                               'updated_at': datetime.utcnow(),
+                                                               **(_search_fields(book) if book.title else {})},
+                                                      '$unset': dict.fromkeys(VOLUME_FIELDS, '')},
+                                                     projection={'bookshelves': 1},
+                                                     return_document=ReturnDocument.BEFORE, upsert=True)
+
+    old_bookshelves = set(old_book.get('bookshelves', [])) if old_book else set()
+    await update_counters(book.user_id, added=set(book.bookshelves) - old_bookshelves,
+                          removed=old_bookshelves - set(book.bookshelves), total=0 if old_book else 1)
+    await bump_library_version(book.user_id)
+
+    return BookModel.from_document({**(old_book or {}), **book.dict(include={'google_id', 'user_id', 'bookshelves',
+                                                                             *VOLUME_FIELDS})})
+
+
+async def upsert_bookshelf_books(user_id: ObjectId, bookshelf_id: int, books: list[BookModel], synced_at: datetime):
+    await upsert_volumes(books)
+
+    operations = [
+        UpdateOne({'user_id': user_id, 'google_id': book.google_id},
+                  {'$set': {f'synced_at.{bookshelf_id}': synced_at, **_search_fields(book)},
+                   '$addToSet': {'bookshelves': bookshelf_id},
+                   '$unset': dict.fromkeys(VOLUME_FIELDS, '')}, upsert=True)
+        for book in books
+    ]
+    try:
+        await db['books'].bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # Two shelves may upsert the same new book at once, the loser is retried as an update
+        duplicates = [operations[error['index']] for error in e.details['writeErrors'] if error['code'] == 11000]
+        if len(duplicates) != len(e.details['writeErrors']):
+            raise
+        await db['books'].bulk_write(duplicates, ordered=False)
+
+
+async def remove_unsynced_bookshelf_books(user_id: ObjectId, bookshelf_id: int, synced_at: datetime,
+                                          exclude_google_ids: set[str] = None) -> int:
+    query = {'user_id': user_id, 'bookshelves': bookshelf_id, f'synced_at.{bookshelf_id}': {'$ne': synced_at},
+             'updated_at': {'$not': {'$gte': synced_at}}}
+    if exclude_google_ids:
+        query['google_id'] = {'$nin': list(exclude_google_ids)}
+
+    # Books changed locally after the sync had started, or not pushed to google yet, are left for the next sync
+    result = await db['books'].update_many(query, {'$pull': {'bookshelves': bookshelf_id},
+                                                   '$unset': {f'synced_at.{bookshelf_id}': ''}})
+
+    # Books removed from their last shelf are not in the library anymore
+    del query['bookshelves'], query[f'synced_at.{bookshelf_id}']
+    await db['books'].delete_many({**query, 'bookshelves': []})
+
+    return result.modified_count
+
+
+async def get_bookshelves_fingerprints(user_id: ObjectId) -> dict[int, str]:
+    fingerprints = {}
+    async for document in db['bookshelves_fingerprints'].find({'user_id': user_id}):
+        fingerprints[document['bookshelf_id']] = document['fingerprint']
+
+    return fingerprints
+
+
+async def set_bookshelf_fingerprint(user_id: ObjectId, bookshelf_id: int, fingerprint: str):
+    await db['bookshelves_fingerprints'].update_one({'user_id': user_id, 'bookshelf_id': bookshelf_id},
+                                                    {'$set': {'fingerprint': fingerprint}}, upsert=True)
+
+
+async def add_books_to_bookshelves(user_id: ObjectId, books: list[BookModel],
+                                   updated_at: datetime) -> dict[str, list[int]]:
+    # The shelves before the update, google is told only about the added ones
+    old_bookshelves = {book.google_id: [] for book in books}
+    async for document in db['books'].find({'user_id': user_id, 'google_id': {'$in': list(old_bookshelves)}},
+                                           {'google_id': 1, 'bookshelves': 1}):
+        old_bookshelves[document['google_id']] = document.get('bookshelves', [])
+
+    operations = [
+        UpdateOne({'user_id': user_id, 'google_id': book.google_id},
+                  {'$addToSet': {'bookshelves': {'$each': book.bookshelves}},
+                   '$set': {'updated_at': updated_at, **_search_fields(book)},
+                   '$unset': dict.fromkeys(VOLUME_FIELDS, '')}, upsert=True)
+        for book in books
+    ]
+    if operations:
+        await db['books'].bulk_write(operations, ordered=False)
+
+    return old_bookshelves
+
+
+async def search_library_books(user_id: ObjectId, q: str, prefix: bool = False, limit: int = None,
+                               offset: int = 0) -> tuple[list[BookModelRead], int]:
+    if prefix:
+        # Type-ahead matches the beginning of the title and is served from the (user_id, title_norm) index
+        query = {'user_id': user_id, 'title_norm': {'$regex': '^' + re.escape(normalize_text(q))}}
+        cursor = db['books'].find(query, BOOK_READ_PROJECTION).sort([('title_norm', ASCENDING), ('_id', ASCENDING)])
+    else:
+        query = {'user_id': user_id, '$text': {'$search': normalize_text(q)}}
+        cursor = db['books'].find(query, {**BOOK_READ_PROJECTION, 'score': {'$meta': 'textScore'}}) \
+            .sort([('score', {'$meta': 'textScore'}), ('_id', ASCENDING)])
+
+    total_items = await db['books'].count_documents(query)
+    documents = await cursor.skip(offset).limit(limit or 0).to_list(length=limit)
+    await join_volumes(documents)
+
+    return [BookModelRead.from_document(book) for book in documents], total_items
+
+
+async def backfill_search_fields():
+    # Books written before the library search existed have no search fields
+    count, chunk = 0, []
+    async for document in db['books'].find({'title_norm': {'$exists': False}}, {'google_id': 1, **VOLUME_PROJECTION}):
+        chunk.append(document)
+        if len(chunk) >= SYNC_BULK_WRITE_SIZE:
+            count += await _backfill_search_fields(chunk)
+            chunk = []
+    count += await _backfill_search_fields(chunk)
+
+    logger.info(f'Backfilled search fields of {count} books')
+
+
+async def _backfill_search_fields(documents: list[dict]) -> int:
+    operations = [UpdateOne({'_id': document['_id']},
+                            {'$set': _search_fields(BookModel.from_document({'title': '', **document}))})
+                  for document in await join_volumes(documents)]
+    if operations:
+        await db['books'].bulk_write(operations, ordered=False)
+
+    return len(operations)
+
 
-    return BookModel.parse_obj(new_book)
+if __name__ == '__main__':
+    # python -m services.books
+    asyncio.run(backfill_search_fields())
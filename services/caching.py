@@ -1,21 +1,91 @@
-import aioredis
+import asyncio
+import time
+from typing import Awaitable, Callable
 
-from data.config import REDIS_URL, SEARCH_RESULTS_CACHING_TIME, REDIS_CASHING_DB
+from data.config import SEARCH_RESULTS_CACHING_TIME, REDIS_CASHING_DB, SEARCH_RESULTS_LOCAL_CACHE_SIZE, \
+    SEARCH_RESULTS_LOCAL_CACHING_TIME, SEARCH_RESULTS_STALE_TIME, SEARCH_RESULTS_REFRESH_LOCK_TIME
+from models import BooksResponse
+from utils.cache import TTLCache
+from utils.misc.logging import logger
+from utils.redis import get_redis, acquire_lock, release_lock
 
+# In-process cache in front of redis, only keeps fresh results
+search_results_cache = TTLCache(SEARCH_RESULTS_LOCAL_CACHE_SIZE,
+                                min(SEARCH_RESULTS_LOCAL_CACHING_TIME, SEARCH_RESULTS_CACHING_TIME))
 
-async def set_cache_data(key: str, value: str, ex: int = SEARCH_RESULTS_CACHING_TIME):
-    redis = aioredis.from_url(REDIS_URL + f'?db={REDIS_CASHING_DB}', decode_responses=True)
+_loading: dict[str, asyncio.Task] = {}
 
-    await redis.set(key, value, ex=ex)
+BooksLoader = Callable[[], Awaitable[BooksResponse]]
 
-    await redis.close()
 
+async def get_search_results(key: str, loader: BooksLoader) -> BooksResponse:
+    books_response = search_results_cache.get(key)
+    if books_response is None:
+        value, fresh_until = await get_redis(REDIS_CASHING_DB).hmget(f'search:{key}', 'value', 'fresh_until')
+        if value is not None:
+            books_response = BooksResponse.parse_raw(value)
+            ttl = float(fresh_until) - time.time()
+            if ttl > 0:
+                search_results_cache.set(key, books_response, ttl)
+            elif key not in _loading:
+                # Serve the stale result while a single request refreshes it
+                _start_loading(key, loader, wait=False).add_done_callback(_log_loading_error)
 
-async def get_cache_data(key: str) -> str | None:
-    redis = aioredis.from_url(REDIS_URL + f'?db={REDIS_CASHING_DB}', decode_responses=True)
+    if books_response is None:
+        task = _loading.get(key) or _start_loading(key, loader, wait=True)
+        books_response = await asyncio.shield(task)
+        if books_response is None:
+            # Joined a stale refresh that was not ours to make
+            books_response = await asyncio.shield(_start_loading(key, loader, wait=True))
 
-    result = await redis.get(key)
+    # Callers replace items with user books, the cached response must stay untouched
+    return books_response.copy()
 
-    await redis.close()
 
-    return result
+async def set_search_results(key: str, books_response: BooksResponse):
+    value = {'value': books_response.json(), 'fresh_until': time.time() + SEARCH_RESULTS_CACHING_TIME}
+    async with get_redis(REDIS_CASHING_DB).pipeline(transaction=True) as pipe:
+        pipe.hset(f'search:{key}', mapping=value)
+        pipe.expire(f'search:{key}', SEARCH_RESULTS_CACHING_TIME + SEARCH_RESULTS_STALE_TIME)
+        await pipe.execute()
+    search_results_cache.set(key, books_response)
+
+
+def _start_loading(key: str, loader: BooksLoader, wait: bool) -> asyncio.Task:
+    task = asyncio.create_task(_load_search_results(key, loader, wait))
+    _loading[key] = task
+    task.add_done_callback(lambda t: _loading.pop(key) if _loading.get(key) is t else None)
+    return task
+
+
+async def _load_search_results(key: str, loader: BooksLoader, wait: bool) -> BooksResponse | None:
+    redis = get_redis(REDIS_CASHING_DB)
+    lock_key = f'search:lock:{key}'
+
+    # The lock makes a single worker of the cluster call google for the key
+    token = await acquire_lock(redis, lock_key, SEARCH_RESULTS_REFRESH_LOCK_TIME)
+    if token is None:
+        if not wait:
+            return None
+
+        deadline = time.monotonic() + SEARCH_RESULTS_REFRESH_LOCK_TIME / 1000
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            value = await redis.hget(f'search:{key}', 'value')
+            if value is not None:
+                return BooksResponse.parse_raw(value)
+
+        # The other worker did not make it in time, load it ourselves
+        return await loader()
+
+    try:
+        books_response = await loader()
+        await set_search_results(key, books_response)
+        return books_response
+    finally:
+        await release_lock(redis, lock_key, token)
+
+
+def _log_loading_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error(f'Refresh search results error {type(task.exception()).__name__} {task.exception()}')
@@ -0,0 +1,68 @@
+import asyncio
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from utils.db import db
+from utils.misc.logging import logger
+
+
+async def update_counters(user_id: ObjectId, added: set[int] = None, removed: set[int] = None, total: int = 0):
+    increments = {f'bookshelves.{id}': 1 for id in added or ()}
+    increments.update({f'bookshelves.{id}': -1 for id in removed or ()})
+    if total:
+        increments['total'] = total
+
+    # Missing counters are recounted on the first read, so they are never created partially here
+    if increments:
+        await db['bookshelves_counters'].update_one({'_id': user_id}, {'$inc': increments})
+
+
+async def count_books(user_id: ObjectId, bookshelves: list[int] = None) -> int | None:
+    # Only the whole library and single shelves are counted
+    if bookshelves and len(bookshelves) > 1:
+        return None
+
+    counters = await db['bookshelves_counters'].find_one({'_id': user_id})
+    if counters is None:
+        counters = await recount_books(user_id)
+
+    if not bookshelves:
+        return max(counters.get('total', 0), 0)
+    return max(counters.get('bookshelves', {}).get(str(bookshelves[0]), 0), 0)
+
+
+async def recount_books(user_id: ObjectId, bookshelves: list[int] = None) -> dict:
+    query = {'user_id': user_id}
+    if bookshelves:
+        query['bookshelves'] = {'$in': bookshelves}
+
+    counts = {str(id): 0 for id in bookshelves or ()}
+    async for item in db['books'].aggregate([{'$match': query}, {'$unwind': '$bookshelves'},
+                                             {'$group': {'_id': '$bookshelves', 'count': {'$sum': 1}}}]):
+        if not bookshelves or item['_id'] in bookshelves:
+            counts[str(item['_id'])] = item['count']
+
+    if bookshelves:
+        update = {f'bookshelves.{id}': count for id, count in counts.items()}
+    else:
+        # Rebuilt as a whole so counters of removed shelves are dropped too
+        update = {'bookshelves': counts}
+    update['total'] = await db['books'].count_documents({'user_id': user_id})
+
+    return await db['bookshelves_counters'].find_one_and_update({'_id': user_id}, {'$set': update}, upsert=True,
+                                                                return_document=ReturnDocument.AFTER)
+
+
+async def repair_counters():
+    async for user in db['users'].find({}, {'_id': 1}):
+        counters = await db['bookshelves_counters'].find_one({'_id': user['_id']})
+        repaired = await recount_books(user['_id'])
+        if counters and (counters.get('total') != repaired.get('total') or
+                         counters.get('bookshelves') != repaired.get('bookshelves')):
+            logger.info(f'Repaired bookshelves counters, user_id={user["_id"]}')
+
+
+if __name__ == '__main__':
+    # python -m services.counters
+    asyncio.run(repair_counters())
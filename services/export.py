@@ -0,0 +1,72 @@
+import csv
+import io
+import zlib
+from typing import AsyncIterator
+
+import orjson
+from bson import ObjectId
+
+from data.config import EXPORT_BATCH_SIZE, EXPORT_CHUNK_SIZE
+from utils.db import db
+
+EXPORT_FIELDS = ('google_id', 'title', 'authors', 'image', 'bookshelves')
+
+
+def _volume_field(field: str) -> dict:
+    # Books saved before the volumes catalog existed keep their own copy of the field,
+    # null when neither has it so every row has the same keys
+    return {'$ifNull': [{'$ifNull': [{'$arrayElemAt': [f'$volume.{field}', 0]}, f'${field}']}, None]}
+
+
+async def iter_library(user_id: ObjectId) -> AsyncIterator[dict]:
+    pipeline = [
+        {'$match': {'user_id': user_id}},
+        {'$sort': {'_id': 1}},
+        {'$lookup': {'from': 'volumes', 'localField': 'google_id', 'foreignField': '_id', 'as': 'volume'}},
+        {'$project': {'_id': 0, 'google_id': 1, 'bookshelves': {'$ifNull': ['$bookshelves', []]},
+                      'title': _volume_field('title'), 'authors': _volume_field('authors'),
+                      'image': _volume_field('image')}},
+    ]
+
+    async for document in db['books'].aggregate(pipeline, batchSize=EXPORT_BATCH_SIZE):
+        yield document
+
+
+async def iter_ndjson(documents: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    chunk = bytearray()
+    async for document in documents:
+        chunk += orjson.dumps(document, option=orjson.OPT_APPEND_NEWLINE)
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk.clear()
+
+    if chunk:
+        yield bytes(chunk)
+
+
+async def iter_csv(documents: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+
+    async for document in documents:
+        writer.writerow((document['google_id'], document.get('title') or '',
+                         ';'.join(document.get('authors') or []), document.get('image') or '',
+                         ';'.join(map(str, document.get('bookshelves') or []))))
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip header and trailer
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
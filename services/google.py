@@ -1,12 +1,19 @@
+import asyncio
+import time
 from typing import NamedTuple
 from urllib.parse import urlencode
 
-import requests
-
-from data.config import GOOGLE_OAUTH_CLIENT_ID, GOOGLE_OAUTH_CLIENT_SECRET
+from data.config import GOOGLE_OAUTH_CLIENT_ID, GOOGLE_OAUTH_CLIENT_SECRET, REDIS_TOKENS_DB, \
+    GOOGLE_TOKENS_REFRESH_LOCK_TIME, GOOGLE_TOKENS_REFRESH_AHEAD, GOOGLE_TOKENS_REFRESH_INTERVAL, USERS_ACTIVE_TIME
 from exceptions import GoogleCodeTokenError, GoogleTokenError, GoogleGetUserinfoError
 from models import UserCredentialsModel, UserModel
-from services.users import update_user_credentials
+from services.users import update_user_credentials, get_user_by_id, get_active_users_ids, \
+    get_users_with_expiring_credentials
+from utils.http import request_json
+from utils.misc.logging import logger
+from utils.redis import get_redis, acquire_lock, release_lock
+
+_refreshing: dict[str, asyncio.Task] = {}
 
 
 class Token(NamedTuple):
@@ -53,7 +60,7 @@ def generate_auth_uri(redirect_uri: str, scope: list[str] = None, state: str = N
     return url + urlencode(params)
 
 
-def get_token(code: str, redirect_uri: str, **kwargs) -> Token:
+async def get_token(code: str, redirect_uri: str, **kwargs) -> Token:
     url = 'https://accounts.google.com/o/oauth2/token'
     params = {
         'code': code,
@@ -65,7 +72,7 @@ def get_token(code: str, redirect_uri: str, **kwargs) -> Token:
     }
     params.update(kwargs)
 
-    response = requests.request('POST', url, data=params).json()
+    response = await request_json('POST', url, data=params)
     if 'error' in response:
         raise GoogleCodeTokenError(response)
 
@@ -73,7 +80,7 @@ def get_token(code: str, redirect_uri: str, **kwargs) -> Token:
                  refresh_token=response['refresh_token'] if 'refresh_token' in response else None)
 
 
-def get_refreshed_token(refresh_token: str, **kwargs) -> Token:
+async def get_refreshed_token(refresh_token: str, **kwargs) -> Token:
     url = 'https://accounts.google.com/o/oauth2/token'
     params = {
         'refresh_token': refresh_token,
@@ -83,7 +90,7 @@ def get_refreshed_token(refresh_token: str, **kwargs) -> Token:
     }
     params.update(kwargs)
 
-    response = requests.request('POST', url, data=params).json()
+    response = await request_json('POST', url, data=params)
 
     if 'error' in response:
         raise GoogleTokenError(response)
@@ -93,8 +100,48 @@ def get_refreshed_token(refresh_token: str, **kwargs) -> Token:
 
 
 async def refresh_user_tokens(user: UserModel) -> UserModel:
-    access_data = get_refreshed_token(user.credentials.refresh_token)
-    tokeninfo = get_tokeninfo(access_data.access_token)
+    # Concurrent refreshes of the same user in the process share a single one
+    key = str(user.id)
+    task = _refreshing.get(key)
+    if task is None:
+        task = asyncio.create_task(_refresh_user_tokens(user))
+        _refreshing[key] = task
+        task.add_done_callback(lambda t: _refreshing.pop(key) if _refreshing.get(key) is t else None)
+
+    return await asyncio.shield(task)
+
+
+async def _refresh_user_tokens(user: UserModel) -> UserModel:
+    redis = get_redis(REDIS_TOKENS_DB)
+    lock_key = f'lock:refresh_google_tokens:{user.id}'
+
+    # Across workers the lock holder refreshes, the others wait for its credentials in the database
+    lock = await acquire_lock(redis, lock_key, GOOGLE_TOKENS_REFRESH_LOCK_TIME)
+    if lock is None:
+        deadline = time.monotonic() + GOOGLE_TOKENS_REFRESH_LOCK_TIME / 1000
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            new_user = await get_user_by_id(user.id, use_cache=False)
+            if new_user and new_user.credentials.expires_in > user.credentials.expires_in:
+                return new_user
+
+        lock = await acquire_lock(redis, lock_key, GOOGLE_TOKENS_REFRESH_LOCK_TIME)
+
+    try:
+        # The previous lock holder may have just finished
+        new_user = await get_user_by_id(user.id, use_cache=False)
+        if new_user and new_user.credentials.expires_in > user.credentials.expires_in:
+            return new_user
+
+        return await _refresh_credentials(new_user or user)
+    finally:
+        if lock:
+            await release_lock(redis, lock_key, lock)
+
+
+async def _refresh_credentials(user: UserModel) -> UserModel:
+    access_data = await get_refreshed_token(user.credentials.refresh_token)
+    tokeninfo = await get_tokeninfo(access_data.access_token)
 
     user_credentials = UserCredentialsModel(
         access_token=access_data.access_token,
@@ -105,12 +152,12 @@ async def refresh_user_tokens(user: UserModel) -> UserModel:
     return await update_user_credentials(user.id, user_credentials)
 
 
-def get_userinfo(access_token: str) -> UserInfo:
+async def get_userinfo(access_token: str) -> UserInfo:
     headers = {
         'Authorization': f'Bearer {access_token}'
     }
 
-    response = requests.request('GET', 'https://www.googleapis.com/oauth2/v1/userinfo', headers=headers).json()
+    response = await request_json('GET', 'https://www.googleapis.com/oauth2/v1/userinfo', headers=headers)
 
     if 'error' in response:
         raise GoogleGetUserinfoError(response)
@@ -119,14 +166,38 @@ def get_userinfo(access_token: str) -> UserInfo:
                     picture=response['picture'], locale=response['locale'])
 
 
-def get_tokeninfo(access_token: str) -> Tokeninfo:
+async def get_tokeninfo(access_token: str) -> Tokeninfo:
     params = {
         'access_token': access_token
     }
 
-    response = requests.request('GET', 'https://oauth2.googleapis.com/tokeninfo', params=params).json()
+    response = await request_json('GET', 'https://oauth2.googleapis.com/tokeninfo', params=params)
 
     if 'error' in response:
         raise GoogleTokenError(response)
 
     return Tokeninfo(scope=response['scope'], exp=response['exp'], sub=response['sub'], email=response['email'])
+
+
+async def refresh_active_users_tokens():
+    expires_before = int(time.time()) + GOOGLE_TOKENS_REFRESH_AHEAD
+    users_ids = await get_active_users_ids(time.time() - USERS_ACTIVE_TIME)
+    for user in await get_users_with_expiring_credentials(users_ids, expires_before):
+        try:
+            await refresh_user_tokens(user)
+        except GoogleTokenError as e:
+            logger.error(f'Refresh tokens of {user.id=} {type(e).__name__} {e}')
+
+
+async def run_tokens_refresher():
+    # Refreshes google tokens of recently active users before they expire, so requests do not have to
+    redis = get_redis(REDIS_TOKENS_DB)
+    while True:
+        lock = await acquire_lock(redis, 'lock:refresh_active_users_tokens', GOOGLE_TOKENS_REFRESH_INTERVAL * 1000)
+        if lock:
+            try:
+                await refresh_active_users_tokens()
+            except Exception as e:
+                logger.error(f'Refresh active users tokens {type(e).__name__} {e}')
+
+        await asyncio.sleep(GOOGLE_TOKENS_REFRESH_INTERVAL)
@@ -1,24 +1,35 @@
-import json
+import asyncio
 import time
+import weakref
+from collections import deque
+from typing import AsyncIterator
 
-import requests
 from fastapi import HTTPException, status
 
-from data.config import GOOGLE_BOOKS_API_KEY
+from data.config import GOOGLE_BOOKS_API_KEY, GOOGLE_SYNC_USER_CONCURRENCY, GOOGLE_SYNC_GLOBAL_CONCURRENCY
 from exceptions import GoogleTokenError, GoogleGetBookshelvesError, GoogleGetBookshelfError, GoogleAddToBookshelfError, \
     GoogleRemoveFromBookshelfError
 from models import BookshelfModel, BookModel, UserModel
 from services.google import refresh_user_tokens
+from utils.http import google_books_request
 from utils.misc.logging import logger
+from utils.rate_limiter import PRIORITY_INTERACTIVE
+
+_global_semaphore = asyncio.Semaphore(GOOGLE_SYNC_GLOBAL_CONCURRENCY)
+_users_semaphores = weakref.WeakValueDictionary()
 
 
 class GoogleBookshelvesService:
     DEFAULT_SKIP_BOOKSHELVES = [1, 5, 6, 7, 8, 9]
+    PAGE_SIZE = 40
 
     @classmethod
-    async def create(cls, user: UserModel):
+    async def create(cls, user: UserModel, priority: int = PRIORITY_INTERACTIVE):
         self = GoogleBookshelvesService()
         self.user = user
+        self.priority = priority
+        # Shared by every service of the same user, so parallel syncs do not multiply the concurrency
+        self.semaphore = _users_semaphores.setdefault(str(user.id), asyncio.Semaphore(GOOGLE_SYNC_USER_CONCURRENCY))
         if user.credentials.expires_in <= int(time.time()) + 5:
             logger.error(f'Try refresh user tokens, {user.id=}')
             try:
@@ -30,7 +41,10 @@ class GoogleBookshelvesService:
             self.user = new_user
         return self
 
-    def get_my_bookshelves(self, skip_bookshelves=None) -> list[BookshelfModel]:
+    async def get_my_bookshelves(self, skip_bookshelves=None) -> list[BookshelfModel]:
+        return [bookshelf for bookshelf, _ in await self.get_my_bookshelves_fingerprints(skip_bookshelves)]
+
+    async def get_my_bookshelves_fingerprints(self, skip_bookshelves=None) -> list[tuple[BookshelfModel, str]]:
         if skip_bookshelves is None:
             skip_bookshelves = self.DEFAULT_SKIP_BOOKSHELVES
         url = 'https://www.googleapis.com/books/v1/mylibrary/bookshelves'
@@ -39,7 +53,7 @@ class GoogleBookshelvesService:
         }
         params = {'key': GOOGLE_BOOKS_API_KEY}
 
-        response = requests.request('GET', url, headers=headers, params=params).json()
+        response = await google_books_request('GET', url, headers=headers, params=params, priority=self.priority)
         if 'error' in response:
             raise GoogleGetBookshelvesError(response)
 
@@ -47,12 +61,19 @@ class GoogleBookshelvesService:
         for item in response['items']:
             if item['id'] in skip_bookshelves:
                 continue
-            bookshelves.append(BookshelfModel(id=item['id'], title=item['title']))
+            # Changes whenever a volume is added to or removed from the shelf
+            fingerprint = f'{item.get("volumeCount", 0)}:{item.get("volumesLastUpdated", item.get("updated", ""))}'
+            bookshelves.append((BookshelfModel(id=item['id'], title=item['title']), fingerprint))
 
         return bookshelves
 
-    def get_bookshelf_books(self, id: int, start_index: int = None, max_results: int = None,
-                            print_type: str = 'books', projection: str = 'lite') -> list[BookModel]:
+    async def get_bookshelf_books(self, id: int, start_index: int = None, max_results: int = None,
+                                  print_type: str = 'books', projection: str = 'lite') -> list[BookModel]:
+        books, _ = await self.get_bookshelf_volumes(id, start_index, max_results, print_type, projection)
+        return books
+
+    async def get_bookshelf_volumes(self, id: int, start_index: int = None, max_results: int = None,
+                                    print_type: str = 'books', projection: str = 'lite') -> tuple[list[BookModel], int]:
         url = f'https://www.googleapis.com/books/v1/mylibrary/bookshelves/{id}/volumes'
         headers = {
             'Authorization': f'Bearer {self.user.credentials.access_token}'
@@ -66,11 +87,13 @@ class GoogleBookshelvesService:
         }
         params = dict(filter(lambda i: i[1] is not None, params.items()))
 
-        response = requests.request('GET', url, headers=headers, params=params).json()
+        async with self.semaphore, _global_semaphore:
+            response = await google_books_request('GET', url, headers=headers, params=params,
+                                                  priority=self.priority)
         if 'error' in response:
             raise GoogleGetBookshelfError(response)
         if response['totalItems'] == 0 or 'items' not in response:
-            return []
+            return [], response['totalItems']
 
         books = []
         for item in response['items']:
@@ -82,58 +105,74 @@ class GoogleBookshelvesService:
                 image=volume_info['imageLinks']['thumbnail'] if volume_info['readingModes']['image'] else None,
             ))
 
-        return books
+        return books, response['totalItems']
 
-    def get_all_bookshelf_books(self) -> list[BookModel]:
-        bookshelves = self.get_my_bookshelves()
+    async def iter_bookshelf_volumes(self, id: int) -> AsyncIterator[list[BookModel]]:
+        books, total_items = await self.get_bookshelf_volumes(id, 0, max_results=self.PAGE_SIZE)
+        yield books
+        if len(books) < self.PAGE_SIZE:
+            return
 
-        total_books = {}
-        for bookshelf in bookshelves:
-            start_index = 0
+        # The first page tells how many volumes there are, the next pages are requested ahead in a bounded window
+        fetched = len(books)
+        start_indexes = iter(range(self.PAGE_SIZE, total_items, self.PAGE_SIZE))
+        window = deque()
+        try:
             while True:
-                books = self.get_bookshelf_books(bookshelf.id, start_index, max_results=40)
-                if not books or len(books) < 1:
+                while len(window) < GOOGLE_SYNC_USER_CONCURRENCY:
+                    start_index = next(start_indexes, None)
+                    if start_index is None:
+                        break
+                    window.append(asyncio.create_task(
+                        self.get_bookshelf_books(id, start_index, max_results=self.PAGE_SIZE)))
+                if not window:
                     break
 
-                for book in books:
-                    if book.google_id not in total_books:
-                        book.bookshelves = [bookshelf.id]
-                        total_books[book.google_id] = book
-                    else:
-                        total_books[book.google_id].bookshelves.append(bookshelf.id)
-
-                start_index += 40
-
-        return total_books.values()
-
-    def add_book_to_bookshelf(self, bookshelf_id: int, book_id: str):
+                page = await window.popleft()
+                fetched += len(page)
+                yield page
+        finally:
+            for task in window:
+                task.cancel()
+
+        # totalItems is only an estimation, keep paging until google returns a partial page
+        start_index = max(-(-total_items // self.PAGE_SIZE) * self.PAGE_SIZE, self.PAGE_SIZE)
+        while fetched == start_index:
+            page = await self.get_bookshelf_books(id, start_index, max_results=self.PAGE_SIZE)
+            if not page:
+                break
+            fetched += len(page)
+            start_index += self.PAGE_SIZE
+            yield page
+
+    async def add_book_to_bookshelf(self, bookshelf_id: int, book_id: str):
         url = f'https://www.googleapis.com/books/v1/mylibrary/bookshelves/{bookshelf_id}/addVolume'
 
-        payload = json.dumps({
+        payload = {
             'volumeId': book_id
-        })
+        }
         headers = {
             'Accept': 'application/json',
             'Authorization': f'Bearer {self.user.credentials.access_token}',
             'Content-Type': 'application/json'
         }
 
-        response = requests.request('POST', url, headers=headers, data=payload).json()
+        response = await google_books_request('POST', url, headers=headers, json=payload, priority=self.priority)
         if 'error' in response:
             raise GoogleAddToBookshelfError(response)
 
-    def remove_book_from_bookshelf(self, bookshelf_id: int, book_id: str):
+    async def remove_book_from_bookshelf(self, bookshelf_id: int, book_id: str):
         url = f'https://www.googleapis.com/books/v1/mylibrary/bookshelves/{bookshelf_id}/removeVolume'
 
-        payload = json.dumps({
+        payload = {
             'volumeId': book_id
-        })
+        }
         headers = {
             'Accept': 'application/json',
             'Authorization': f'Bearer {self.user.credentials.access_token}',
             'Content-Type': 'application/json'
         }
 
-        response = requests.request('POST', url, headers=headers, data=payload).json()
+        response = await google_books_request('POST', url, headers=headers, json=payload, priority=self.priority)
         if 'error' in response:
             raise GoogleRemoveFromBookshelfError(response)
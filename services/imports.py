@@ -0,0 +1,184 @@
+import asyncio
+import csv
+import io
+import re
+from datetime import datetime
+
+from bson import ObjectId
+
+from data.config import IMPORT_MAX_ENTRIES, IMPORT_BATCH_SIZE, IMPORT_CONCURRENCY, IMPORT_MAX_FAILURES
+from exceptions import InvalidImportFileError, GoogleBooksSearchError
+from models import BookModel, BooksImportModelRead
+from services.books import search_google_books, get_volumes_by_isbns, add_volumes_isbns, upsert_volumes, \
+    add_books_to_bookshelves
+from services.counters import recount_books
+from services.jobs import job, enqueue_job
+from services.users import get_user_by_id
+from services.versions import bump_library_version
+from services.write_behind import buffer_bookshelves_changes
+from utils.db import db
+from utils.misc.logging import logger
+from utils.rate_limiter import PRIORITY_BACKGROUND
+
+GOODREADS_BOOKSHELVES = {'read': 4, 'currently-reading': 3, 'to-read': 2}
+IMPORT_PROJECTION = BooksImportModelRead.projection()
+
+
+def normalize_isbn(value: str | None) -> str | None:
+    # Goodreads exports ISBNs as ="0123456789"
+    isbn = re.sub(r'[^0-9X]', '', (value or '').upper())
+    return isbn if len(isbn) in (10, 13) else None
+
+
+def parse_import_file(content: bytes, bookshelf_id: int) -> list[dict]:
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise InvalidImportFileError('The file must be utf-8 encoded')
+
+    first_line = text.split('\n', 1)[0]
+    if 'Title' in first_line and 'ISBN' in first_line:
+        entries = _parse_goodreads_csv(text, bookshelf_id)
+    else:
+        entries = [{'isbn': isbn, 'title': None, 'author': None, 'bookshelves': [bookshelf_id]}
+                   for isbn in map(normalize_isbn, re.split(r'[\s,;]+', text)) if isbn]
+
+    # The same book may be listed several times, its shelves are merged
+    unique_entries = {}
+    for entry in entries:
+        key = entry['isbn'] or f'{entry["title"]}:{entry["author"]}'
+        if key in unique_entries:
+            unique_entries[key]['bookshelves'] = sorted({*unique_entries[key]['bookshelves'], *entry['bookshelves']})
+        else:
+            unique_entries[key] = entry
+
+    if not unique_entries:
+        raise InvalidImportFileError('No books found in the file')
+    if len(unique_entries) > IMPORT_MAX_ENTRIES:
+        raise InvalidImportFileError(f'Only {IMPORT_MAX_ENTRIES} books can be imported at once')
+
+    return list(unique_entries.values())
+
+
+def _parse_goodreads_csv(text: str, bookshelf_id: int) -> list[dict]:
+    entries = []
+    for row in csv.DictReader(io.StringIO(text)):
+        isbn = normalize_isbn(row.get('ISBN13')) or normalize_isbn(row.get('ISBN'))
+        title = (row.get('Title') or '').strip() or None
+        if not isbn and not title:
+            continue
+
+        entries.append({'isbn': isbn, 'title': title, 'author': (row.get('Author') or '').strip() or None,
+                        'bookshelves': [GOODREADS_BOOKSHELVES.get(row.get('Exclusive Shelf'), bookshelf_id)]})
+
+    return entries
+
+
+async def create_import(user_id: ObjectId, entries: list[dict]) -> BooksImportModelRead:
+    document = {'user_id': user_id, 'status': 'pending', 'total': len(entries), 'processed': 0, 'imported': 0,
+                'failed': 0, 'failures': [], 'entries': entries, 'createdAt': datetime.utcnow(), 'finishedAt': None}
+    result = await db['imports'].insert_one(document)
+
+    await enqueue_job('import_books', {'import_id': str(result.inserted_id)})
+
+    return BooksImportModelRead.from_document(document)
+
+
+async def get_import(user_id: ObjectId, id: str) -> BooksImportModelRead | None:
+    if not ObjectId.is_valid(id):
+        return None
+
+    document = await db['imports'].find_one({'_id': ObjectId(id), 'user_id': user_id}, IMPORT_PROJECTION)
+    return BooksImportModelRead.from_document(document) if document else None
+
+
+@job('import_books')
+async def import_books_job(import_id: str):
+    books_import = await db['imports'].find_one({'_id': ObjectId(import_id)})
+    if not books_import or books_import['status'] == 'done':
+        return
+
+    user = await get_user_by_id(str(books_import['user_id']), use_cache=False)
+    if not user:
+        await db['imports'].update_one({'_id': books_import['_id']},
+                                       {'$set': {'status': 'failed', 'finishedAt': datetime.utcnow()}})
+        return
+
+    await db['imports'].update_one({'_id': books_import['_id']}, {'$set': {'status': 'running'}})
+
+    # A retried job continues after the last imported batch
+    entries = books_import['entries']
+    semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    for start in range(books_import['processed'], len(entries), IMPORT_BATCH_SIZE):
+        batch = entries[start:start + IMPORT_BATCH_SIZE]
+        imported, failures = await _import_batch(user.id, batch, semaphore)
+
+        await db['imports'].update_one({'_id': books_import['_id']},
+                                       {'$set': {'processed': start + len(batch)},
+                                        '$inc': {'imported': imported, 'failed': len(failures)},
+                                        '$push': {'failures': {'$each': failures, '$slice': IMPORT_MAX_FAILURES}}})
+        await bump_library_version(user.id)
+
+    await recount_books(user.id)
+    await bump_library_version(user.id)
+    await db['imports'].update_one({'_id': books_import['_id']},
+                                   {'$set': {'status': 'done', 'finishedAt': datetime.utcnow()}})
+
+
+async def _import_batch(user_id: ObjectId, entries: list[dict], semaphore: asyncio.Semaphore) -> tuple[int, list[str]]:
+    known_volumes = await get_volumes_by_isbns([entry['isbn'] for entry in entries if entry['isbn']])
+    books = await asyncio.gather(*(_resolve_entry(semaphore, entry, known_volumes) for entry in entries))
+
+    volumes, bookshelves, new_volumes, new_isbns, failures = {}, {}, {}, {}, []
+    for entry, book in zip(entries, books):
+        if book is None:
+            failures.append(entry['isbn'] or entry['title'])
+            continue
+
+        if entry['isbn'] not in known_volumes:
+            new_volumes[book.google_id] = book
+            if entry['isbn']:
+                new_isbns[entry['isbn']] = book.google_id
+        volumes[book.google_id] = book
+        bookshelves.setdefault(book.google_id, set()).update(entry['bookshelves'])
+
+    await upsert_volumes(list(new_volumes.values()), overwrite=False)
+    await add_volumes_isbns(new_isbns)
+
+    old_bookshelves = await add_books_to_bookshelves(user_id, [
+        volumes[google_id].copy(update={'bookshelves': sorted(ids)}) for google_id, ids in bookshelves.items()
+    ], datetime.utcnow())
+
+    # Google gets the added shelves in batches through the write-behind buffer
+    await buffer_bookshelves_changes(str(user_id), {
+        google_id: (old_bookshelves[google_id], sorted(ids | set(old_bookshelves[google_id])))
+        for google_id, ids in bookshelves.items() if not ids <= set(old_bookshelves[google_id])
+    }, priority=PRIORITY_BACKGROUND)
+
+    return len(bookshelves), failures
+
+
+async def _resolve_entry(semaphore: asyncio.Semaphore, entry: dict,
+                         known_volumes: dict[str, BookModel]) -> BookModel | None:
+    if entry['isbn'] in known_volumes:
+        return known_volumes[entry['isbn']]
+
+    queries = []
+    if entry['isbn']:
+        queries.append(f'isbn:{entry["isbn"]}')
+    if entry['title']:
+        queries.append(f'intitle:{entry["title"]}' + (f' inauthor:{entry["author"]}' if entry['author'] else ''))
+
+    # Books without a known ISBN are looked up by their title
+    for query in queries:
+        async with semaphore:
+            try:
+                response = await search_google_books(query, max_results=1, priority=PRIORITY_BACKGROUND)
+            except GoogleBooksSearchError as e:
+                logger.error(f'{type(e).__name__} {e}')
+                continue
+
+        if response.items:
+            return BookModel(**response.items[0].dict())
+
+    return None
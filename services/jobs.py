@@ -0,0 +1,154 @@
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable
+
+from aioredis.exceptions import ResponseError
+
+from data.config import REDIS_JOBS_DB, JOBS_VISIBILITY_TIMEOUT, JOBS_MAX_RETRIES, JOBS_RETRY_DELAY, \
+    JOBS_WORKER_CONCURRENCY, JOBS_DEDUPLICATION_TIME
+from utils.misc.logging import logger
+from utils.redis import get_redis
+
+JOBS_STREAM = 'jobs:stream'
+JOBS_DELAYED = 'jobs:delayed'
+JOBS_GROUP = 'workers'
+
+_handlers: dict[str, Callable[..., Awaitable]] = {}
+
+# Moves delayed jobs which are due to the stream in one atomic step
+_move_due_jobs_script = '''
+local jobs = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job in ipairs(jobs) do
+    redis.call('xadd', KEYS[2], '*', 'job', job)
+    redis.call('zrem', KEYS[1], job)
+end
+return #jobs
+'''
+
+
+def job(name: str):
+    def decorator(handler: Callable[..., Awaitable]):
+        _handlers[name] = handler
+        return handler
+
+    return decorator
+
+
+async def enqueue_job(name: str, payload: dict, dedup_key: str = None, delay: float = 0, attempt: int = 0) -> bool:
+    redis = get_redis(REDIS_JOBS_DB)
+
+    # Only one pending job per key, it is released as soon as the job starts
+    if dedup_key and not await redis.set(f'jobs:pending:{dedup_key}', 1, nx=True, ex=JOBS_DEDUPLICATION_TIME):
+        return False
+
+    message = json.dumps({'name': name, 'payload': payload, 'dedup_key': dedup_key, 'attempt': attempt,
+                          'enqueued_at': time.time()})
+    if delay > 0:
+        await redis.zadd(JOBS_DELAYED, {message: time.time() + delay})
+    else:
+        await redis.xadd(JOBS_STREAM, {'job': message})
+
+    return True
+
+
+async def run_worker(consumer: str):
+    redis = get_redis(REDIS_JOBS_DB)
+    try:
+        await redis.xgroup_create(JOBS_STREAM, JOBS_GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+    running = set()
+    logger.info(f'Worker {consumer} started, jobs: {", ".join(_handlers)}')
+
+    while True:
+        try:
+            await redis.eval(_move_due_jobs_script, 2, JOBS_DELAYED, JOBS_STREAM, time.time())
+
+            # Jobs of crashed workers become visible again after the visibility timeout
+            messages = await _claim_stale_messages(redis, consumer, JOBS_WORKER_CONCURRENCY - len(running))
+            free = JOBS_WORKER_CONCURRENCY - len(running) - len(messages)
+            if free > 0:
+                for _, stream_messages in await redis.xreadgroup(JOBS_GROUP, consumer, {JOBS_STREAM: '>'},
+                                                                 count=free, block=1000) or []:
+                    messages.extend(stream_messages)
+            elif not messages:
+                await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Worker {consumer} {type(e).__name__} {e}')
+            await asyncio.sleep(1)
+            continue
+
+        # No more messages are read than there are free slots, so running never exceeds the concurrency
+        for message_id, fields in messages:
+            task = asyncio.create_task(_process(redis, consumer, message_id, fields))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+
+async def _claim_stale_messages(redis, consumer: str, count: int) -> list[tuple[str, dict]]:
+    if count <= 0:
+        return []
+
+    result = await redis.execute_command('XAUTOCLAIM', JOBS_STREAM, JOBS_GROUP, consumer, JOBS_VISIBILITY_TIMEOUT,
+                                         '0-0', 'COUNT', count)
+    # Deleted messages are returned without fields
+    return [(message_id, dict(zip(fields[::2], fields[1::2]))) for message_id, fields in result[1] if fields]
+
+
+async def _keep_visible(redis, consumer: str, message_id: str):
+    # Resets the idle time so a long job is not claimed by another worker
+    while True:
+        await asyncio.sleep(JOBS_VISIBILITY_TIMEOUT / 3000)
+        await redis.xclaim(JOBS_STREAM, JOBS_GROUP, consumer, 0, [message_id], justid=True)
+
+
+async def _process(redis, consumer: str, message_id: str, fields: dict):
+    heartbeat = asyncio.create_task(_keep_visible(redis, consumer, message_id))
+    try:
+        await _run_job(redis, message_id, fields)
+    except asyncio.CancelledError:
+        # A stopped worker leaves the message pending, it is claimed again after the visibility timeout
+        raise
+    except Exception as e:
+        # Neither done nor re-enqueued, e.g. redis went away, so it is claimed again too
+        logger.error(f'Job {message_id} {type(e).__name__} {e}')
+    else:
+        # Acked only once the job succeeded, was re-enqueued or dropped
+        await redis.xack(JOBS_STREAM, JOBS_GROUP, message_id)
+        await redis.xdel(JOBS_STREAM, message_id)
+    finally:
+        heartbeat.cancel()
+
+
+async def _run_job(redis, message_id: str, fields: dict):
+    try:
+        message = json.loads(fields['job'])
+    except (KeyError, ValueError) as e:
+        logger.error(f'Job {message_id} dropped, invalid message {type(e).__name__} {e}')
+        return
+
+    if message['dedup_key']:
+        await redis.delete(f'jobs:pending:{message["dedup_key"]}')
+
+    handler = _handlers.get(message['name'])
+    if handler is None:
+        logger.error(f'Unknown job {message["name"]}')
+        return
+
+    try:
+        await handler(**message['payload'])
+    except Exception as e:
+        attempt = message['attempt'] + 1
+        if attempt > JOBS_MAX_RETRIES:
+            logger.error(f'Job {message["name"]} failed {attempt} times, dropped {type(e).__name__} {e}')
+            return
+
+        logger.error(f'Job {message["name"]} failed, retry {attempt} {type(e).__name__} {e}')
+        # The retry keeps the dedup key, so no second job for the same key is queued next to it
+        await enqueue_job(message['name'], message['payload'], dedup_key=message['dedup_key'],
+                          delay=JOBS_RETRY_DELAY * 2 ** (attempt - 1), attempt=attempt)
@@ -0,0 +1,73 @@
+import asyncio
+from collections import Counter
+
+from data.config import REDIS_CASHING_DB, SUGGESTIONS_SIZE, SUGGESTIONS_REFRESH_INTERVAL
+from services.caching import search_results_cache
+from utils.misc.logging import logger
+from utils.prefix_index import PrefixIndex
+from utils.redis import get_redis
+from utils.text import normalize_text
+
+POPULAR_QUERIES_KEY = 'search:popular'
+
+# Rebuilt in the background and replaced as a whole, requests only read it
+suggestions_index = PrefixIndex()
+# Searches are counted in memory and added to redis on the next rebuild, so a search waits for no network call
+_queries_hits: Counter[str] = Counter()
+
+
+def record_search_query(q: str):
+    query = normalize_text(q)
+    if query and (query in _queries_hits or len(_queries_hits) < SUGGESTIONS_SIZE):
+        _queries_hits[query] += 1
+
+
+async def _flush_queries_hits(redis):
+    queries_hits = dict(_queries_hits)
+    _queries_hits.clear()
+    if queries_hits:
+        async with redis.pipeline(transaction=False) as pipe:
+            for query, hits in queries_hits.items():
+                pipe.zincrby(POPULAR_QUERIES_KEY, hits, query)
+            await pipe.execute()
+
+
+def suggest(prefix: str, limit: int = 10) -> list[str]:
+    return suggestions_index.search(normalize_text(prefix), limit)
+
+
+async def rebuild_suggestions():
+    global suggestions_index
+
+    redis = get_redis(REDIS_CASHING_DB)
+    await _flush_queries_hits(redis)
+    popular_queries = dict(await redis.zrevrange(POPULAR_QUERIES_KEY, 0, SUGGESTIONS_SIZE - 1, withscores=True))
+    # Rarely searched queries are forgotten
+    await redis.zremrangebyrank(POPULAR_QUERIES_KEY, 0, -SUGGESTIONS_SIZE - 1)
+
+    entries = {query: (query, score) for query, score in popular_queries.items()}
+
+    # Titles found by the cached searches are suggested as popular as their query
+    for key, books_response in search_results_cache.items():
+        score = popular_queries.get(normalize_text(key.rsplit(':', 2)[0]), 1)
+        for book in books_response.items:
+            title = normalize_text(book.title or '')
+            if title and entries.get(title, (None, 0))[1] < score:
+                entries[title] = (book.title, score)
+
+    if len(entries) > SUGGESTIONS_SIZE:
+        entries = dict(sorted(entries.items(), key=lambda item: item[1][1], reverse=True)[:SUGGESTIONS_SIZE])
+
+    suggestions_index = PrefixIndex(entries)
+
+
+async def run_suggestions_refresher():
+    while True:
+        try:
+            await rebuild_suggestions()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Rebuild suggestions error {type(e).__name__} {e}')
+
+        await asyncio.sleep(SUGGESTIONS_REFRESH_INTERVAL)
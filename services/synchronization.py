@@ -1,22 +1,36 @@
-from exceptions import GoogleAddToBookshelfError, GoogleRemoveFromBookshelfError, GoogleGetBookshelvesError, GoogleGetUserinfoError
+import asyncio
+from datetime import datetime
+from typing import Awaitable
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+from data.config import SYNC_BULK_WRITE_SIZE
+from exceptions import GoogleGetBookshelvesError, GoogleGetUserinfoError, GoogleGetBookshelfError
 from models import UserModel, BookModel
-from services.books import get_or_create_book
+from services.books import upsert_bookshelf_books, remove_unsynced_bookshelf_books, get_bookshelves_fingerprints, \
+    set_bookshelf_fingerprint
+from services.counters import recount_books
 from services.google import get_userinfo
 from services.google_bookshelves import GoogleBookshelvesService
-from services.users import update_or_create_user
+from services.jobs import job
+from services.users import update_or_create_user, get_user_by_id
+from services.versions import bump_library_version
+from services.write_behind import get_buffered_google_ids
 from utils.misc.logging import logger
+from utils.rate_limiter import PRIORITY_BACKGROUND
 
 
 async def synchronize_user(user: UserModel):
-    service = await GoogleBookshelvesService.create(user)
+    service = await GoogleBookshelvesService.create(user, priority=PRIORITY_BACKGROUND)
     try:
-        bookshelves = service.get_my_bookshelves()
+        bookshelves = await service.get_my_bookshelves()
         user.bookshelves = bookshelves
     except GoogleGetBookshelvesError as e:
         logger.error(f'{type(e).__name__} {e}')
 
     try:
-        userinfo = get_userinfo(service.user.credentials.access_token)
+        userinfo = await get_userinfo(service.user.credentials.access_token)
         user.email = userinfo.email
         user.name = userinfo.name
         user.picture = userinfo.picture
@@ -27,37 +41,75 @@ async def synchronize_user(user: UserModel):
     await update_or_create_user(user)
 
 
-async def synchronize_books(user: UserModel):
-    service = await GoogleBookshelvesService.create(user)
+async def synchronize_books(user: UserModel, force: bool = False):
+    service = await GoogleBookshelvesService.create(user, priority=PRIORITY_BACKGROUND)
     try:
-        books = service.get_all_bookshelf_books()
+        bookshelves = await service.get_my_bookshelves_fingerprints()
     except GoogleGetBookshelvesError as e:
         logger.error(f'{type(e).__name__} {e}')
         return
 
-    for book in books:
-        book.user_id = user.id
-        await get_or_create_book(book)
+    # Only shelves changed on google since the last sync are crawled again
+    fingerprints = {} if force else await get_bookshelves_fingerprints(user.id)
+    changed_bookshelves = [(bookshelf, fingerprint) for bookshelf, fingerprint in bookshelves
+                           if fingerprints.get(bookshelf.id) != fingerprint]
+    if not changed_bookshelves:
+        return
+
+    synced_at = datetime.utcnow()
+    await asyncio.gather(*(_synchronize_bookshelf(service, user.id, bookshelf.id, fingerprint, synced_at)
+                           for bookshelf, fingerprint in changed_bookshelves))
 
+    await recount_books(user.id, [bookshelf.id for bookshelf, _ in changed_bookshelves])
+    await bump_library_version(user.id)
 
-async def synchronize_bookshelves_books(user: UserModel, old_bookshelves: list, book: BookModel):
-    old_bookshelves = set(old_bookshelves) if old_bookshelves else set()
-    new_bookshelves = set(book.bookshelves)
 
-    # Find difference between old and new bookshelves
-    to_delete = old_bookshelves.difference(new_bookshelves)
-    to_add = new_bookshelves.difference(old_bookshelves)
+async def _synchronize_bookshelf(service: GoogleBookshelvesService, user_id: ObjectId, bookshelf_id: int,
+                                 fingerprint: str, synced_at: datetime):
+    chunk = []
+    try:
+        async for books in service.iter_bookshelf_volumes(bookshelf_id):
+            chunk.extend(books)
+            if len(chunk) >= SYNC_BULK_WRITE_SIZE:
+                await _upsert_bookshelf_books(user_id, bookshelf_id, chunk, synced_at)
+                chunk = []
+    except GoogleGetBookshelfError as e:
+        # Without the whole shelf we can not tell which books were removed from it
+        logger.error(f'{type(e).__name__} {e}')
+        return
+
+    if chunk:
+        await _upsert_bookshelf_books(user_id, bookshelf_id, chunk, synced_at)
 
-    service = await GoogleBookshelvesService.create(user)
+    await remove_unsynced_bookshelf_books(user_id, bookshelf_id, synced_at,
+                                          exclude_google_ids=await get_buffered_google_ids(str(user_id)))
+    await set_bookshelf_fingerprint(user_id, bookshelf_id, fingerprint)
 
-    for id in to_delete:
-        try:
-            service.remove_book_from_bookshelf(id, book.google_id)
-        except GoogleRemoveFromBookshelfError as e:
-            logger.error(f'{type(e).__name__} {e}')
 
-    for id in to_add:
-        try:
-            service.add_book_to_bookshelf(id, book.google_id)
-        except GoogleAddToBookshelfError as e:
-            logger.error(f'{type(e).__name__} {e}')
+async def _upsert_bookshelf_books(user_id: ObjectId, bookshelf_id: int, books: list[BookModel], synced_at: datetime):
+    # Books with local changes google does not have yet keep their local shelves
+    buffered = await get_buffered_google_ids(str(user_id))
+    await upsert_bookshelf_books(user_id, bookshelf_id, [book for book in books if book.google_id not in buffered],
+                                 synced_at)
+
+
+@job('synchronize_user')
+async def synchronize_user_job(user_id: str):
+    user = await get_user_by_id(user_id, use_cache=False)
+    if user:
+        await _run_without_permission_retries(synchronize_user(user))
+
+
+@job('synchronize_books')
+async def synchronize_books_job(user_id: str, force: bool = False):
+    user = await get_user_by_id(user_id, use_cache=False)
+    if user:
+        await _run_without_permission_retries(synchronize_books(user, force=force))
+
+
+async def _run_without_permission_retries(synchronization: Awaitable):
+    try:
+        await synchronization
+    except HTTPException as e:
+        # The user took back the permission to manage google books, retrying will not help
+        logger.error(f'{type(e).__name__} {e.status_code} {e.detail}')
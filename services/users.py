@@ -1,33 +1,140 @@
+import asyncio
+import time
+
 from bson import ObjectId
 from fastapi.encoders import jsonable_encoder
 from pymongo import ReturnDocument
 
+from data.config import USERS_CACHE_SIZE, USERS_CACHING_TIME, REDIS_TOKENS_DB, USERS_ACTIVE_TIME
+from utils.cache import TTLCache
 from utils.db import db
 from models import UserModel, UserCredentialsModel
+from utils.misc.logging import logger
+from services.versions import bump_library_version
+from utils.redis import get_redis
+
+USERS_INVALIDATION_CHANNEL = 'users:invalidate'
+USERS_ACTIVE_KEY = 'users:active'
+
+# Per worker cache of authenticated users, other workers are told to drop a user when it changes
+users_cache = TTLCache(USERS_CACHE_SIZE, USERS_CACHING_TIME)
+# Users whose activity was recently written to redis
+_active_users = TTLCache(USERS_CACHE_SIZE, 60)
+# Generation and number of running loads of the users being loaded from the database. Invalidations bump
+# the generation, so a load which read the user before a change does not put the old user in the cache.
+_loading_generations: dict[str, list[int]] = {}
+
+USER_PROJECTION = UserModel.projection()
+
+
+async def get_user_by_id(id: str, use_cache: bool = True) -> UserModel | None:
+    user = users_cache.get(str(id)) if use_cache else None
+    if user is None:
+        loading = _loading_generations.setdefault(str(id), [0, 0])
+        generation = loading[0]
+        loading[1] += 1
+        try:
+            document = await db['users'].find_one({'_id': ObjectId(id)}, USER_PROJECTION)
+        finally:
+            loading[1] -= 1
+            if not loading[1]:
+                del _loading_generations[str(id)]
 
+        if not document:
+            return None
 
-async def get_user_by_id(id: str) -> UserModel | None:
-    user = await db['users'].find_one({'_id': ObjectId(id)})
-    return UserModel.parse_obj(user) if user else None
+        user = UserModel.from_document(document)
+        # Callers which skip the cache want the latest user, and they are the ones changing it
+        if use_cache and loading[0] == generation:
+            users_cache.set(str(id), user)
+
+    # Callers are free to change the returned user
+    return user.copy()
+
+
+async def get_users_with_expiring_credentials(ids: list[str], expires_before: int) -> list[UserModel]:
+    users = []
+    async for document in db['users'].find({'_id': {'$in': [ObjectId(id) for id in ids]},
+                                            'credentials.expires_in': {'$lte': expires_before},
+                                            'credentials.refresh_token': {'$ne': None}}, USER_PROJECTION):
+        users.append(UserModel.from_document(document))
+
+    return users
 
 
 async def get_user_by_google_id(google_id: str) -> UserModel | None:
-    user = await db['users'].find_one({'google_id': google_id})
-    return UserModel.parse_obj(user) if user else None
+    user = await db['users'].find_one({'google_id': google_id}, USER_PROJECTION)
+    return UserModel.from_document(user) if user else None
 
 
 async def update_or_create_user(user: UserModel) -> UserModel:
     new_user = await db['users'].find_one_and_update({'google_id': user.google_id},
                                                      {'$set': jsonable_encoder(user, exclude=['id'], exclude_none=True,
                                                                                exclude_unset=True)},
+                                                     projection=USER_PROJECTION,
                                                      return_document=ReturnDocument.AFTER, upsert=True)
 
-    return UserModel.parse_obj(new_user)
+    new_user = UserModel.from_document(new_user)
+    await invalidate_user(new_user.id)
+    await bump_library_version(new_user.id)
+    return new_user
 
 
 async def update_user_credentials(id: str, credentials: UserCredentialsModel) -> UserModel:
     new_user = await db['users'].find_one_and_update({'_id': ObjectId(id)},
                                                      {'$set': {'credentials': credentials.dict()}},
+                                                     projection=USER_PROJECTION,
                                                      return_document=ReturnDocument.AFTER, upsert=True)
 
-    return UserModel.parse_obj(new_user)
+    new_user = UserModel.from_document(new_user)
+    await invalidate_user(new_user.id)
+    return new_user
+
+
+async def mark_user_active(id: str):
+    if _active_users.get(str(id)) is None:
+        _active_users.set(str(id), True)
+        async with get_redis(REDIS_TOKENS_DB).pipeline(transaction=False) as pipe:
+            pipe.zadd(USERS_ACTIVE_KEY, {str(id): time.time()})
+            pipe.zremrangebyscore(USERS_ACTIVE_KEY, '-inf', time.time() - USERS_ACTIVE_TIME)
+            await pipe.execute()
+
+
+async def get_active_users_ids(since: float) -> list[str]:
+    return await get_redis(REDIS_TOKENS_DB).zrangebyscore(USERS_ACTIVE_KEY, since, '+inf')
+
+
+def _drop_user(id: str):
+    users_cache.pop(id)
+    if id in _loading_generations:
+        _loading_generations[id][0] += 1
+
+
+def _drop_all_users():
+    users_cache.clear()
+    for loading in _loading_generations.values():
+        loading[0] += 1
+
+
+async def invalidate_user(id: str):
+    _drop_user(str(id))
+    await get_redis(REDIS_TOKENS_DB).publish(USERS_INVALIDATION_CHANNEL, str(id))
+
+
+async def listen_users_invalidation():
+    while True:
+        pubsub = get_redis(REDIS_TOKENS_DB).pubsub()
+        try:
+            await pubsub.subscribe(USERS_INVALIDATION_CHANNEL)
+            # Invalidations could have been missed while (re)connecting
+            _drop_all_users()
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    _drop_user(message['data'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Users invalidation listener {type(e).__name__} {e}')
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
@@ -0,0 +1,47 @@
+import hashlib
+import uuid
+
+from bson import ObjectId
+from fastapi import Request
+
+from data.config import REDIS_CASHING_DB, LIBRARY_VERSION_TIME
+from utils.redis import get_redis
+
+LIBRARY_VERSION_KEY = 'library:version:{}'
+
+
+async def get_library_version(user_id: ObjectId | str) -> str:
+    redis = get_redis(REDIS_CASHING_DB)
+    version = await redis.get(LIBRARY_VERSION_KEY.format(user_id))
+    if version is None:
+        # Versions are random, so a lost one never matches an etag the clients already have
+        await redis.set(LIBRARY_VERSION_KEY.format(user_id), uuid.uuid4().hex, nx=True, ex=LIBRARY_VERSION_TIME)
+        version = await redis.get(LIBRARY_VERSION_KEY.format(user_id))
+
+    return version
+
+
+async def bump_library_version(user_id: ObjectId | str):
+    await get_redis(REDIS_CASHING_DB).set(LIBRARY_VERSION_KEY.format(user_id), uuid.uuid4().hex,
+                                          ex=LIBRARY_VERSION_TIME)
+
+
+async def get_library_etag(user_id: ObjectId | str, request: Request) -> str:
+    version = await get_library_version(user_id)
+    digest = hashlib.sha1(f'{user_id}:{version}:{request.url.path}?{request.url.query}'.encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+
+    # If-None-Match uses the weak comparison
+    return if_none_match.strip() == '*' or \
+        etag in (value.strip().removeprefix('W/') for value in if_none_match.split(','))
+
+
+def etag_headers(etag: str) -> dict[str, str]:
+    # Clients keep the response but revalidate it on every use
+    return {'ETag': etag, 'Cache-Control': 'private, no-cache'}
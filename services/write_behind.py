@@ -0,0 +1,172 @@
+import asyncio
+import json
+import time
+
+from data.config import REDIS_JOBS_DB, WRITE_BEHIND_DEBOUNCE_TIME, WRITE_BEHIND_CONCURRENCY, JOBS_MAX_RETRIES, \
+    JOBS_RETRY_DELAY, WRITE_BEHIND_MAX_DELAY
+from exceptions import GoogleAddToBookshelfError, GoogleRemoveFromBookshelfError
+from services.google_bookshelves import GoogleBookshelvesService
+from services.jobs import job, enqueue_job
+from services.users import get_user_by_id
+from utils.misc.logging import logger
+from utils.rate_limiter import PRIORITY_INTERACTIVE
+from utils.redis import get_redis
+
+# Per user buffers of shelves changes: google's last known shelves and the latest desired shelves of every book
+KNOWN_KEY = 'writebehind:{}:known'
+DESIRED_KEY = 'writebehind:{}:desired'
+# Rate limiter priority of the flush, a book changed by the user is flushed as interactive
+PRIORITY_KEY = 'writebehind:{}:priority'
+# Times of the last and of the first unflushed change, the flush waits until the changes settle
+CHANGED_AT_KEY = 'writebehind:{}:changed_at'
+FIRST_CHANGED_AT_KEY = 'writebehind:{}:first_changed_at'
+BUFFER_TIME = 60 * 60 * 24
+
+# Removes a flushed change unless a newer one was buffered meanwhile, which then starts from what google has
+_complete_change_script = """
+if redis.call('hget', KEYS[2], ARGV[1]) == ARGV[2] then
+    redis.call('hdel', KEYS[1], ARGV[1])
+    redis.call('hdel', KEYS[2], ARGV[1])
+    redis.call('hdel', KEYS[3], ARGV[1])
+else
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[3])
+end
+"""
+
+
+async def buffer_bookshelves_change(user_id: str, google_id: str, old_bookshelves: list[int] | None,
+                                    bookshelves: list[int], priority: int = PRIORITY_INTERACTIVE):
+    await buffer_bookshelves_changes(user_id, {google_id: (old_bookshelves, bookshelves)}, priority)
+
+
+async def buffer_bookshelves_changes(user_id: str, changes: dict[str, tuple[list[int] | None, list[int]]],
+                                     priority: int = PRIORITY_INTERACTIVE):
+    if not changes:
+        return
+
+    async with get_redis(REDIS_JOBS_DB).pipeline(transaction=True) as pipe:
+        for google_id, (old_bookshelves, bookshelves) in changes.items():
+            # Only the first change of a burst knows what google has
+            pipe.hsetnx(KNOWN_KEY.format(user_id), google_id, json.dumps(old_bookshelves or []))
+            pipe.hset(DESIRED_KEY.format(user_id), google_id, json.dumps(bookshelves))
+            if priority == PRIORITY_INTERACTIVE:
+                pipe.hset(PRIORITY_KEY.format(user_id), google_id, priority)
+            else:
+                pipe.hsetnx(PRIORITY_KEY.format(user_id), google_id, priority)
+        pipe.expire(KNOWN_KEY.format(user_id), BUFFER_TIME)
+        pipe.expire(DESIRED_KEY.format(user_id), BUFFER_TIME)
+        pipe.expire(PRIORITY_KEY.format(user_id), BUFFER_TIME)
+        pipe.set(CHANGED_AT_KEY.format(user_id), time.time(), ex=BUFFER_TIME)
+        pipe.set(FIRST_CHANGED_AT_KEY.format(user_id), time.time(), ex=BUFFER_TIME, nx=True)
+        await pipe.execute()
+
+    # Only the first change of a burst enqueues the flush, which is postponed by the later ones
+    await enqueue_job('flush_bookshelves_changes', {'user_id': user_id},
+                      dedup_key=f'flush_bookshelves_changes:{user_id}', delay=WRITE_BEHIND_DEBOUNCE_TIME)
+
+
+async def get_bookshelves_changes(user_id: str) -> dict[str, tuple[set[int], set[int], str, int]]:
+    # The changes stay buffered until google has them, so a crashed flush is retried with them
+    async with get_redis(REDIS_JOBS_DB).pipeline(transaction=True) as pipe:
+        pipe.hgetall(KNOWN_KEY.format(user_id))
+        pipe.hgetall(DESIRED_KEY.format(user_id))
+        pipe.hgetall(PRIORITY_KEY.format(user_id))
+        known, desired, priorities = await pipe.execute()
+
+    return {google_id: (set(json.loads(known.get(google_id, '[]'))), set(json.loads(bookshelves)), bookshelves,
+                        int(priorities.get(google_id, PRIORITY_INTERACTIVE)))
+            for google_id, bookshelves in desired.items()}
+
+
+async def get_buffered_google_ids(user_id: str) -> set[str]:
+    return set(await get_redis(REDIS_JOBS_DB).hkeys(DESIRED_KEY.format(user_id)))
+
+
+async def _complete_bookshelves_change(user_id: str, google_id: str, flushed: str, known: set[int]):
+    await get_redis(REDIS_JOBS_DB).eval(_complete_change_script, 3, KNOWN_KEY.format(user_id),
+                                        DESIRED_KEY.format(user_id), PRIORITY_KEY.format(user_id), google_id, flushed,
+                                        json.dumps(sorted(known)))
+
+
+async def _rebuffer_bookshelves_change(user_id: str, google_id: str, known: set[int]):
+    # What google has is certain now, the desired shelves are still buffered
+    await get_redis(REDIS_JOBS_DB).hset(KNOWN_KEY.format(user_id), google_id, json.dumps(sorted(known)))
+
+
+@job('flush_bookshelves_changes')
+async def flush_bookshelves_changes_job(user_id: str, attempt: int = 0):
+    user = await get_user_by_id(user_id, use_cache=False)
+    if not user:
+        return
+
+    if not attempt and await _postpone_flush(user_id):
+        return
+
+    changes = await get_bookshelves_changes(user_id)
+    if not changes:
+        return
+
+    # Imported books are flushed with the background priority, so they don't use up the users' requests
+    services = {}
+    for priority in sorted({priority for *_, priority in changes.values()}):
+        services[priority] = await GoogleBookshelvesService.create(user, priority=priority)
+        user = services[priority].user  # the tokens are refreshed once
+    semaphore = asyncio.Semaphore(WRITE_BEHIND_CONCURRENCY)
+    give_up = attempt >= JOBS_MAX_RETRIES
+    results = await asyncio.gather(*(_flush_book_changes(services[priority], semaphore, google_id, known, desired,
+                                                         flushed, give_up)
+                                     for google_id, (known, desired, flushed, priority) in changes.items()))
+
+    if not all(results) and not give_up:
+        await enqueue_job('flush_bookshelves_changes', {'user_id': user_id, 'attempt': attempt + 1},
+                          dedup_key=f'flush_bookshelves_changes:{user_id}', delay=JOBS_RETRY_DELAY * 2 ** attempt)
+
+
+async def _postpone_flush(user_id: str) -> bool:
+    redis = get_redis(REDIS_JOBS_DB)
+    changed_at, first_changed_at = await redis.mget(CHANGED_AT_KEY.format(user_id),
+                                                    FIRST_CHANGED_AT_KEY.format(user_id))
+    now = time.time()
+    # Waits for a quiet debounce window, but not longer than the max delay since the first change
+    if changed_at and now - float(changed_at) < WRITE_BEHIND_DEBOUNCE_TIME and \
+            now - float(first_changed_at or changed_at) < WRITE_BEHIND_MAX_DELAY:
+        await enqueue_job('flush_bookshelves_changes', {'user_id': user_id},
+                          dedup_key=f'flush_bookshelves_changes:{user_id}',
+                          delay=WRITE_BEHIND_DEBOUNCE_TIME - (now - float(changed_at)))
+        return True
+
+    await redis.delete(FIRST_CHANGED_AT_KEY.format(user_id))
+    return False
+
+
+async def _flush_book_changes(service: GoogleBookshelvesService, semaphore: asyncio.Semaphore, google_id: str,
+                              known: set[int], desired: set[int], flushed: str, give_up: bool = False) -> bool:
+    # Only the net difference is sent, toggles made during the debounce window cancel out
+    to_delete, to_add = sorted(known - desired), sorted(desired - known)
+    results = await asyncio.gather(
+        *(_change_bookshelf(semaphore, service.remove_book_from_bookshelf, id, google_id) for id in to_delete),
+        *(_change_bookshelf(semaphore, service.add_book_to_bookshelf, id, google_id) for id in to_add))
+    if all(results):
+        await _complete_bookshelves_change(str(service.user.id), google_id, flushed, desired)
+        return True
+
+    deleted = {id for id, ok in zip(to_delete, results) if ok}
+    added = {id for id, ok in zip(to_add, results[len(to_delete):]) if ok}
+    if give_up:
+        # Dropped so the next sync takes the shelves from google instead of skipping the book
+        logger.error(f'Gave up pushing bookshelves of {google_id} to google, user_id={service.user.id} '
+                     f'google={sorted((known - deleted) | added)} desired={sorted(desired)}')
+        await _complete_bookshelves_change(str(service.user.id), google_id, flushed, (known - deleted) | added)
+    else:
+        await _rebuffer_bookshelves_change(str(service.user.id), google_id, (known - deleted) | added)
+    return False
+
+
+async def _change_bookshelf(semaphore: asyncio.Semaphore, operation, bookshelf_id: int, google_id: str) -> bool:
+    async with semaphore:
+        try:
+            await operation(bookshelf_id, google_id)
+            return True
+        except (GoogleAddToBookshelfError, GoogleRemoveFromBookshelfError) as e:
+            logger.error(f'{type(e).__name__} {e}')
+            return False
@@ -0,0 +1,65 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from utils.misc.logging import logger
+
+
+# Size bounded in-process LRU cache whose entries expire after ttl seconds
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self) -> list[tuple[Hashable, Any]]:
+        now = time.monotonic()
+        return [(key, value) for key, (expires_at, value) in self._data.items() if expires_at > now]
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+async def log_caches_stats(caches: dict[str, TTLCache], interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        for name, cache in caches.items():
+            stats = cache.stats()
+            requests = stats['hits'] + stats['misses']
+            hit_ratio = stats['hits'] / requests if requests else 0
+            logger.info(f'Cache {name} size={stats["size"]} hits={stats["hits"]} misses={stats["misses"]} '
+                        f'hit_ratio={hit_ratio:.2f}')
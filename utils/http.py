@@ -0,0 +1,68 @@
+import httpx
+
+from data.config import GOOGLE_HTTP2, GOOGLE_HTTP_TIMEOUT, GOOGLE_HTTP_MAX_CONNECTIONS, \
+    GOOGLE_HTTP_MAX_KEEPALIVE_CONNECTIONS, GOOGLE_BOOKS_RATE_LIMIT_RETRIES, GOOGLE_BOOKS_INTERACTIVE_TIMEOUT, \
+    GOOGLE_BOOKS_BACKGROUND_TIMEOUT
+from utils.misc.logging import logger
+from utils.rate_limiter import acquire, penalize, PRIORITY_INTERACTIVE
+
+_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        limits = httpx.Limits(max_connections=GOOGLE_HTTP_MAX_CONNECTIONS,
+                              max_keepalive_connections=GOOGLE_HTTP_MAX_KEEPALIVE_CONNECTIONS)
+        _client = httpx.AsyncClient(http2=GOOGLE_HTTP2, timeout=GOOGLE_HTTP_TIMEOUT, limits=limits)
+    return _client
+
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def request_json(method: str, url: str, **kwargs) -> dict:
+    _, content = await _request(method, url, **kwargs)
+    return content
+
+
+async def google_books_request(method: str, url: str, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> dict:
+    timeout = GOOGLE_BOOKS_INTERACTIVE_TIMEOUT if priority == PRIORITY_INTERACTIVE else \
+        GOOGLE_BOOKS_BACKGROUND_TIMEOUT
+
+    content = {}
+    for _ in range(GOOGLE_BOOKS_RATE_LIMIT_RETRIES + 1):
+        if not await acquire(priority, timeout):
+            return {'error': {'code': 429, 'message': 'Google books api quota is exhausted'}}
+
+        response, content = await _request(method, url, **kwargs)
+        if response is None or response.status_code != 429:
+            return content
+
+        # Slows down every worker, not only this request
+        retry_after = response.headers.get('Retry-After', '')
+        await penalize(float(retry_after) if retry_after.isdigit() else 1)
+
+    return content
+
+
+async def _request(method: str, url: str, **kwargs) -> tuple[httpx.Response | None, dict]:
+    try:
+        response = await get_http_client().request(method, url, **kwargs)
+    except httpx.HTTPError as e:
+        # Keep the google error format so callers raise their own exceptions
+        logger.error(f'{type(e).__name__} {method} {url} {e}')
+        return None, {'error': {'code': 503, 'message': str(e)}}
+
+    try:
+        return response, response.json()
+    except ValueError as e:
+        # Empty or non json bodies, e.g. 204 of addVolume and removeVolume, are fine when the request succeeded
+        if response.is_success:
+            return response, {}
+        logger.error(f'{type(e).__name__} {method} {url} {response.status_code} {e}')
+        return response, {'error': {'code': response.status_code, 'message': response.text}}
@@ -0,0 +1,117 @@
+import asyncio
+import sys
+
+from bson import ObjectId
+from pymongo import IndexModel, ASCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+from utils.db import db
+from utils.misc.logging import logger
+
+INDEXES = {
+    'books': [
+        IndexModel([('user_id', ASCENDING), ('google_id', ASCENDING)], name='user_id_google_id', unique=True),
+        IndexModel([('user_id', ASCENDING), ('bookshelves', ASCENDING), ('_id', ASCENDING)],
+                   name='user_id_bookshelves'),
+        IndexModel([('user_id', ASCENDING), ('_id', ASCENDING)], name='user_id_id'),
+        IndexModel([('user_id', ASCENDING), ('search_text', TEXT)], name='user_id_search_text',
+                   default_language='none'),
+        IndexModel([('user_id', ASCENDING), ('title_norm', ASCENDING)], name='user_id_title_norm'),
+    ],
+    'users': [
+        IndexModel([('google_id', ASCENDING)], name='google_id', unique=True),
+    ],
+    'volumes': [
+        IndexModel([('isbns', ASCENDING)], name='isbns'),
+    ],
+    'bookshelves_fingerprints': [
+        IndexModel([('user_id', ASCENDING), ('bookshelf_id', ASCENDING)], name='user_id_bookshelf_id', unique=True),
+    ],
+}
+
+# Representative filters and sorts of the service queries: (collection, filter, sort)
+_user_id = ObjectId()
+QUERIES = {
+    'books.get_book': ('books', {'user_id': _user_id, 'google_id': 'google_id'}, None),
+    'books.get_books_by_user_id': ('books', {'user_id': _user_id, 'bookshelves': {'$in': [0]}}, [('_id', ASCENDING)]),
+    'books.get_books_by_user_id cursor': ('books', {'user_id': _user_id, 'bookshelves': {'$in': [0]},
+                                                    '_id': {'$gt': _user_id}}, [('_id', ASCENDING)]),
+    'books.get_books_by_user_id library': ('books', {'user_id': _user_id}, [('_id', ASCENDING)]),
+    'books.get_books_by_user_id google_ids': ('books', {'user_id': _user_id, 'google_id': {'$in': ['google_id']}},
+                                              None),
+    'books.search_library_books': ('books', {'user_id': _user_id, '$text': {'$search': 'title'}}, None),
+    'books.search_library_books prefix': ('books', {'user_id': _user_id, 'title_norm': {'$regex': '^title'}},
+                                          [('title_norm', ASCENDING)]),
+    'books.remove_unsynced_bookshelf_books': ('books', {'user_id': _user_id, 'bookshelves': 0,
+                                                        'synced_at.0': {'$ne': None}}, None),
+    'books.remove_unsynced_bookshelf_books empty': ('books', {'user_id': _user_id, 'bookshelves': []}, None),
+    'books.get_bookshelves_fingerprints': ('bookshelves_fingerprints', {'user_id': _user_id}, None),
+    'books.get_volumes_by_isbns': ('volumes', {'isbns': {'$in': ['isbn']}}, None),
+    'imports.get_import': ('imports', {'_id': _user_id, 'user_id': _user_id}, None),
+    'users.get_user_by_google_id': ('users', {'google_id': 'google_id'}, None),
+}
+
+
+def _same_index(existing: dict, document: dict) -> bool:
+    existing_key = []
+    for field, order in existing['key']:
+        # Text indexes are reported by their internal fields, the indexed ones are the weights
+        if field == '_fts':
+            existing_key.extend((text_field, TEXT) for text_field in sorted(existing['weights']))
+        elif field != '_ftsx':
+            existing_key.append((field, int(order) if isinstance(order, float) else order))
+    return existing_key == list(document['key'].items()) and \
+        existing.get('unique', False) == document.get('unique', False)
+
+
+async def ensure_indexes():
+    for collection, indexes in INDEXES.items():
+        existing = await db[collection].index_information()
+        for index in indexes:
+            document = index.document
+            name = document['name']
+            # Created one by one, so an index that can not be built, e.g. unique with duplicates, blocks no other
+            try:
+                # An index with the same name but another definition has to be rebuilt
+                if name in existing and not _same_index(existing[name], document):
+                    logger.info(f'Drop changed index {collection}.{name}')
+                    await db[collection].drop_index(name)
+                await db[collection].create_indexes([index])
+            except OperationFailure as e:
+                logger.error(f'Create index {collection}.{name} error {type(e).__name__} {e}')
+
+
+def _plan_stages(plan: dict) -> list[str]:
+    stages = [plan['stage']] if 'stage' in plan else []
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages.extend(_plan_stages(plan[key]))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(_plan_stages(input_stage))
+
+    return stages
+
+
+async def explain_queries() -> bool:
+    ok = True
+    for name, (collection, query, sort) in QUERIES.items():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+
+        stages = _plan_stages(explanation['queryPlanner']['winningPlan'])
+        print(f'{name}: {" <- ".join(stages)}')
+        if 'COLLSCAN' in stages:
+            ok = False
+
+    return ok
+
+
+if __name__ == '__main__':
+    # python -m utils.indexes [ensure|explain]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'explain'
+    if command == 'ensure':
+        asyncio.run(ensure_indexes())
+    elif not asyncio.run(explain_queries()):
+        sys.exit('COLLSCAN found')
@@ -0,0 +1,34 @@
+import bisect
+import heapq
+
+
+# Immutable sorted array of normalized keys, the keys starting with a prefix are found by binary search.
+# Short prefixes match too many keys to rank them on every lookup, so their best entries are ranked ahead.
+class PrefixIndex:
+    def __init__(self, entries: dict[str, tuple[str, float]] = None, bucket_prefix_length: int = 4,
+                 bucket_size: int = 20):
+        # normalized key -> (text shown to the user, score)
+        items = sorted((entries or {}).items())
+        self.bucket_prefix_length = bucket_prefix_length
+        self.bucket_size = bucket_size
+        self._keys = [key for key, _ in items]
+        self._values = [value for _, value in items]
+
+        buckets: dict[str, list[tuple[str, float]]] = {}
+        for key, value in items:
+            for length in range(1, min(len(key), bucket_prefix_length) + 1):
+                buckets.setdefault(key[:length], []).append(value)
+        self._buckets = {prefix: [text for text, _ in heapq.nlargest(bucket_size, values, key=lambda v: v[1])]
+                         for prefix, values in buckets.items()}
+
+    def search(self, prefix: str, limit: int = 10) -> list[str]:
+        # Lookups of short prefixes return at most bucket_size entries
+        if len(prefix) <= self.bucket_prefix_length:
+            return self._buckets.get(prefix, [])[:limit]
+
+        start = bisect.bisect_left(self._keys, prefix)
+        end = bisect.bisect_left(self._keys, prefix + '\U0010ffff', start)
+        return [text for text, _ in heapq.nlargest(limit, self._values[start:end], key=lambda v: v[1])]
+
+    def __len__(self):
+        return len(self._keys)
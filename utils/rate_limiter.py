@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from data.config import REDIS_CASHING_DB, GOOGLE_BOOKS_RATE_LIMIT, GOOGLE_BOOKS_RATE_LIMIT_BURST, \
+    GOOGLE_BOOKS_BACKGROUND_RESERVE, GOOGLE_BOOKS_RATE_LIMIT_RECOVERY
+from utils.redis import get_redis
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+GOOGLE_BOOKS_BUCKET = 'ratelimit:google_books'
+
+# Token bucket shared by all workers. The refill rate is multiplied by a factor which is halved on every 429
+# and recovers linearly with time. Background requests leave a reserve of tokens to interactive ones.
+_acquire_script = '''
+local state = redis.call('hmget', KEYS[1], 'tokens', 'timestamp', 'factor', 'factor_timestamp', 'blocked_until')
+local now, rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local reserve, recovery = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+local blocked_until = tonumber(state[5]) or 0
+if now < blocked_until then
+    return tostring(blocked_until - now)
+end
+
+local factor = math.min(1, (tonumber(state[3]) or 1) + (now - (tonumber(state[4]) or now)) * recovery)
+local timestamp = tonumber(state[2]) or now
+local tokens = math.min(capacity, (tonumber(state[1]) or capacity) + (now - timestamp) * rate * factor)
+
+local wait = 0
+if tokens >= reserve + 1 then
+    tokens = tokens - 1
+else
+    wait = (reserve + 1 - tokens) / (rate * factor)
+end
+
+redis.call('hset', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('expire', KEYS[1], 3600)
+return tostring(wait)
+'''
+
+_penalize_script = '''
+local state = redis.call('hmget', KEYS[1], 'factor', 'factor_timestamp')
+local now, retry_after, recovery = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+
+local factor = math.min(1, (tonumber(state[1]) or 1) + (now - (tonumber(state[2]) or now)) * recovery)
+redis.call('hset', KEYS[1], 'factor', math.max(factor / 2, 0.05), 'factor_timestamp', now,
+           'tokens', 0, 'timestamp', now + retry_after, 'blocked_until', now + retry_after)
+redis.call('expire', KEYS[1], 3600)
+return 1
+'''
+
+
+async def acquire(priority: int = PRIORITY_INTERACTIVE, timeout: float = 10) -> bool:
+    reserve = 0 if priority == PRIORITY_INTERACTIVE else GOOGLE_BOOKS_RATE_LIMIT_BURST * GOOGLE_BOOKS_BACKGROUND_RESERVE
+    deadline = time.monotonic() + timeout
+    while True:
+        wait = float(await get_redis(REDIS_CASHING_DB).eval(
+            _acquire_script, 1, GOOGLE_BOOKS_BUCKET, time.time(), GOOGLE_BOOKS_RATE_LIMIT,
+            GOOGLE_BOOKS_RATE_LIMIT_BURST, reserve, GOOGLE_BOOKS_RATE_LIMIT_RECOVERY))
+        if wait <= 0:
+            return True
+        if time.monotonic() + wait > deadline:
+            return False
+
+        await asyncio.sleep(wait)
+
+
+async def penalize(retry_after: float):
+    await get_redis(REDIS_CASHING_DB).eval(_penalize_script, 1, GOOGLE_BOOKS_BUCKET, time.time(), retry_after,
+                                           GOOGLE_BOOKS_RATE_LIMIT_RECOVERY)
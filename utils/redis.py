@@ -0,0 +1,36 @@
+import uuid
+
+import aioredis
+
+from data.config import REDIS_URL, REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT, REDIS_SOCKET_CONNECT_TIMEOUT, \
+    REDIS_POOL_TIMEOUT
+
+_pools: dict[int, aioredis.BlockingConnectionPool] = {}
+
+
+def get_redis(db: int) -> aioredis.Redis:
+    if db not in _pools:
+        # Blocking pool waits for a free connection instead of opening more than max_connections
+        _pools[db] = aioredis.BlockingConnectionPool.from_url(REDIS_URL + f'?db={db}', decode_responses=True,
+                                                              max_connections=REDIS_MAX_CONNECTIONS,
+                                                              timeout=REDIS_POOL_TIMEOUT,
+                                                              socket_timeout=REDIS_SOCKET_TIMEOUT,
+                                                              socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT)
+    return aioredis.Redis(connection_pool=_pools[db])
+
+
+async def close_redis_pools():
+    for pool in _pools.values():
+        await pool.disconnect()
+    _pools.clear()
+
+
+async def acquire_lock(redis: aioredis.Redis, key: str, ttl: int) -> str | None:
+    token = uuid.uuid4().hex
+    return token if await redis.set(key, token, px=ttl, nx=True) else None
+
+
+async def release_lock(redis: aioredis.Redis, key: str, token: str):
+    # Delete only our own lock, it may have expired and been taken by someone else
+    await redis.eval("if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0",
+                     1, key, token)
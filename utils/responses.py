@@ -0,0 +1,42 @@
+from typing import Any, Callable
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, BaseModel):
+        return value.dict(by_alias=True)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(value: Any, *, default: Callable[[Any], Any] = None, indent: int = None, sort_keys: bool = False,
+          **kwargs) -> str:
+    # Used as pydantic json_dumps too, which passes its own encoder for the types orjson does not know
+    # and the json.dumps keyword arguments given to .json()
+    if kwargs:
+        raise TypeError(f'Unsupported json options: {", ".join(kwargs)}')
+
+    option = 0
+    if indent is not None:
+        # orjson only indents with two spaces
+        option |= orjson.OPT_INDENT_2
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+
+    if default is None:
+        return orjson.dumps(value, default=_default, option=option).decode()
+
+    def chained_default(v: Any) -> Any:
+        return str(v) if isinstance(v, ObjectId) else default(v)
+
+    return orjson.dumps(value, default=chained_default, option=option).decode()
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
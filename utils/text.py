@@ -0,0 +1,7 @@
+import unicodedata
+
+
+def normalize_text(text: str) -> str:
+    # Case and accents are ignored, so "Émile" is found by "emile"
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ' '.join(''.join(char for char in decomposed if not unicodedata.combining(char)).casefold().split())
@@ -0,0 +1,23 @@
+import asyncio
+import os
+import socket
+
+import services.imports  # noqa: F401 registers the import jobs
+import services.synchronization  # noqa: F401 registers the synchronization jobs
+import services.write_behind  # noqa: F401 registers the write-behind jobs
+from services.google import run_tokens_refresher
+from services.jobs import run_worker
+from utils.http import close_http_client
+from utils.redis import close_redis_pools
+
+
+async def main():
+    try:
+        await asyncio.gather(run_worker(f'{socket.gethostname()}-{os.getpid()}'), run_tokens_refresher())
+    finally:
+        await close_http_client()
+        await close_redis_pools()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())